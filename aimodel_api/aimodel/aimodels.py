@@ -1,96 +1,325 @@
 import os
-import tensorflow as tf
+import time
+import contextvars
 from sqlalchemy.orm import Session
-from typing import Dict
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Optional
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from fastapi import HTTPException
 
 from ..database.models import Model
+from ..database.statistics_buffer import StatisticsBuffer
+from ..database.catalogue import ModelCatalogue
 from .transformations import Transformations, TransformationType
+from .transformation_tree import TransformationTree
+from .pipeline import CompiledPipeline
+from .batching import BatchingQueue
+from .executor import check_deadline, extend_deadline
+from .compiled_model import CompiledModel
+from . import tflite_backend
+from .ensemble import CascadeVote, EnsembleVote
+from .hand_gate import HandPresenceGate
+from .prediction_cache import PredictionCache
+from .model_residency import ModelResidency, ResidentModel
 from ..config import settings
+from ..debug_capture import capture
+from ..metrics import CASCADE_MODELS, FORWARD_SECONDS, MEAN_SECONDS, record, timed_stage
 from ..models import GestureType
 
 import numpy as np
 
-class LoadedModel:
-    def __init__(self, model: tf.keras.models.Model, transforms: list[int]):
-        self.model = model
+# tensorflow is imported on first use, see startup.py
+if TYPE_CHECKING:
+    import tensorflow as tf
+
+# Model registered from the database with its compiled transformation pipeline.
+# The Keras model itself is loaded on first use and kept in ModelResidency
+class RegisteredModel:
+    def __init__(self, path_to_model: str, transforms: list[int], version: str = ""):
+        self.path_to_model = path_to_model
         self.transforms = transforms
+        self.version = version
+        self.pipeline = CompiledPipeline(transforms)
 
 class ModelManager:
     _instance = None
-    loaded_models: Dict[int, LoadedModel] = {}
+    registered_models: Dict[int, RegisteredModel] = {}
+    residency: ModelResidency = None
+    transformation_tree: TransformationTree = None
+    ensemble_executor: ThreadPoolExecutor = None
+    prediction_cache: PredictionCache = None
+    hand_gate: HandPresenceGate = None
+    # Transformations that can't run while the models are preloaded (e.g. MediaPipe in the pre-fork parent), see preload_models
+    skipped_transform_ids: set[int] = set()
+    # Model versions that couldn't be converted to TFLite, they are served by Keras without trying again on every load
+    keras_fallback_versions: set[str] = set()
 
     # Singleton
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = super(ModelManager, cls).__new__(cls, *args, **kwargs)
-            cls._instance.loaded_models = {}  
+            cls._instance.registered_models = {}  
+            cls._instance.keras_fallback_versions = set()
+            cls._instance.residency = ModelResidency(
+                loader=cls._instance._load_resident_model,
+                budget_bytes=int(settings.models_memory_budget_mb * 1024 * 1024),
+            )
+            cls._instance.transformation_tree = TransformationTree()
+            cls._instance.ensemble_executor = ThreadPoolExecutor(max_workers=settings.ensemble_workers, thread_name_prefix="ensemble")
+            cls._instance.prediction_cache = PredictionCache(
+                max_entries=settings.prediction_cache_max_entries if settings.prediction_cache_enabled else 0,
+                ttl_s=settings.prediction_cache_ttl_s,
+            )
+            os.register_at_fork(after_in_child=cls._instance._reinit_after_fork)
         return cls._instance
 
+    # Threads don't survive fork - forked workers (see prefork.py) get new batching queues and ensemble executor,
+    # the models loaded by the parent stay shared copy-on-write
+    def _reinit_after_fork(self):
+        self.ensemble_executor = ThreadPoolExecutor(max_workers=settings.ensemble_workers, thread_name_prefix="ensemble")
+        for model_id, resident in self.residency.resident_items():
+            resident.batching_queue = self._create_batching_queue(model_id, resident.predict_fn)
+
     @staticmethod
-    def _load_model(model_path: str) -> tf.keras.models.Model:
+    def _load_model(model_path: str) -> "tf.keras.models.Model":
+        import tensorflow as tf
+
         path = os.path.join(settings.ai_models_folder, model_path)
         if not os.path.exists(path):
             raise Exception(f'Model file {path} not found')
         return tf.keras.models.load_model(path)
 
-    # Load models from database
+    # Version of the model file, changes whenever the file is replaced
+    @staticmethod
+    def _model_version(model_path: str) -> str:
+        path = os.path.join(settings.ai_models_folder, model_path)
+        if not os.path.exists(path):
+            raise Exception(f'Model file {path} not found')
+        stat = os.stat(path)
+        return f"{model_path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    # Compiled and warmed up forward pass of the model, plain model.predict if compiled inference is disabled
+    @staticmethod
+    def _create_predict_fn(keras_model: "tf.keras.models.Model") -> Callable[[np.ndarray], np.ndarray]:
+        if not settings.compiled_inference:
+            return keras_model.predict
+        compiled_model = CompiledModel(keras_model, traced=settings.traced_inference)
+        compiled_model.warm_up()
+        return compiled_model
+
+    # Calibration samples of the model: the calibration images through the pipeline of the model, the images the pipeline
+    # rejects are skipped. None if a transformation of the pipeline can't run in this process (see preload_models)
+    def _calibration_samples(self, pipeline: CompiledPipeline) -> Optional[list[np.ndarray]]:
+        if self.skipped_transform_ids & set(pipeline.image_transform_ids):
+            return None
+        images = tflite_backend.calibration_images(settings.tflite_calibration_samples)
+        return [sample for image in images if (sample := pipeline.calibration_input(image)) is not None]
+
+    # TFLite forward pass of the model if the TFLite backend is enabled and the converted model agrees with Keras
+    def _create_tflite_predict_fn(self, model_data: RegisteredModel, keras_model: "tf.keras.models.Model", reference_fn) -> Optional[Callable[[np.ndarray], np.ndarray]]:
+        if settings.inference_backend != "tflite" or model_data.version in self.keras_fallback_versions:
+            return None
+        tflite_model = tflite_backend.load_tflite_model(
+            keras_model, model_data.version, reference_fn, lambda: self._calibration_samples(model_data.pipeline),
+        )
+        if tflite_model is None:
+            self.keras_fallback_versions.add(model_data.version)
+        else:
+            tflite_model.warm_up()
+        return tflite_model
+
+    # Converts the model to TFLite ahead of its first use, the model itself is not kept in memory
+    def _convert_tflite_model(self, model_id: int):
+        model_data = self.registered_models[model_id]
+        if os.path.exists(tflite_backend.cache_path(model_data.version, settings.tflite_quantization)) or model_data.version in self.keras_fallback_versions:
+            return
+        keras_model = self._load_model(model_data.path_to_model)
+        self._create_tflite_predict_fn(model_data, keras_model, self._create_predict_fn(keras_model))
+
+    @staticmethod
+    def _create_batching_queue(model_id: int, predict_fn: Callable[[np.ndarray], np.ndarray]) -> BatchingQueue:
+        if not settings.batching_enabled:
+            return None
+        return BatchingQueue(
+            name=f"model-{model_id}",
+            predict_fn=predict_fn,
+            max_batch_size=settings.batching_max_batch_size,
+            max_wait_ms=settings.batching_max_wait_ms,
+        )
+
+    # Loads the model into memory, called by ModelResidency on first use of the model
+    def _load_resident_model(self, model_id: int) -> ResidentModel:
+        model_data = self.registered_models[model_id]
+        start = time.perf_counter()
+        keras_model = self._load_model(model_data.path_to_model)
+        model_data.pipeline.check_model_input(tuple(keras_model.input_shape))
+        predict_fn = self._create_predict_fn(keras_model)
+        tflite_model = self._create_tflite_predict_fn(model_data, keras_model, predict_fn)
+        if tflite_model is not None:
+            # The Keras model is not kept, the converted one is self-contained
+            predict_fn, model, size_bytes = tflite_model, None, len(tflite_model.model_content)
+        else:
+            # Weights are float32
+            model, size_bytes = keras_model, keras_model.count_params() * 4
+        batching_queue = self._create_batching_queue(model_id, predict_fn)
+        print(f"Model {model_id} loaded into memory in {time.perf_counter() - start:.2f}s.")
+        return ResidentModel(model, predict_fn, batching_queue, size_bytes=size_bytes)
+
+    # Register models from database and preload them
     def load_models_from_db(self, db: Session):
+        self.register_models_from_db(db)
+        self.preload_models()
+
+    # Register models from database, the models are not loaded into memory yet
+    def register_models_from_db(self, db: Session):
         models = db.query(Model).all()
-        self.loaded_models = {}
-        for model in models:
-            keras_model = self._load_model(model.path_to_model)
-            transforms = model.transformations
-            self.loaded_models[model.id] = LoadedModel(keras_model, transforms)
-        print(f"{len(self.loaded_models)} models loaded into memory.")
-
-    # Apply transformations to image from list of transformation ids
-    def _apply_transforms(self, image: Image.Image, transforms: list[int]):
+        self.residency.clear()
+        self.registered_models = {
+            model.id: RegisteredModel(model.path_to_model, model.transformations, self._model_version(model.path_to_model))
+            for model in models
+        }
+        self.residency.pinned = set(settings.pinned_model_ids) & set(self.registered_models)
+        # Cached predictions of the previous models are no longer valid
+        self.prediction_cache.clear()
+        # Only the image transformations are shared, the fused tensor preparation runs per model
+        chains = {model_id: model_data.pipeline.image_transform_ids for model_id, model_data in self.registered_models.items()}
+        self.transformation_tree = TransformationTree.from_chains(chains)
+        self.hand_gate = HandPresenceGate.from_chains(chains, settings.hand_gate_transform_ids)
+        # GET /models serves the registered models
+        ModelCatalogue().refresh(db)
+        print(f"{len(self.registered_models)} models registered.")
+
+    # Loads the models into memory in parallel and warms up their transformations, except the skipped ones (MediaPipe graphs
+    # can't be built in the pre-fork parent). With lazy loading only the pinned models are loaded, the others are loaded on
+    # first use. With the TFLite backend all the models (and the U-Net) are converted here, never in a request. Models that
+    # need a skipped transformation to calibrate are only served by TFLite if their conversion is cached
+    def preload_models(self, skipped_transform_ids: Iterable[int] = ()):
+        preload_ids = sorted(self.residency.pinned if settings.lazy_model_loading else self.registered_models)
+        tflite = settings.inference_backend == "tflite"
+        convert_ids = sorted(set(self.registered_models) - set(preload_ids)) if tflite else []
+        # Transformations of the lazily loaded models and the gate checks are warmed up as well, the first request
+        # would wait for the U-Net or MediaPipe otherwise. The models are calibrated on the real transformations,
+        # they are ready before the models load
+        used_transform_ids = {
+            transform_id
+            for model_data in self.registered_models.values()
+            for transform_id in model_data.transforms
+        }
+        if self.hand_gate is not None:
+            used_transform_ids.update(transform_id for check in self.hand_gate.checks for transform_id in check.transform_ids)
+        used_transform_ids -= set(skipped_transform_ids)
+        self.skipped_transform_ids = set(skipped_transform_ids)
+        try:
+            Transformations.warm_up(used_transform_ids)
+            if preload_ids or convert_ids:
+                with ThreadPoolExecutor(max_workers=settings.models_loading_workers, thread_name_prefix="model-loading") as executor:
+                    # Model files are independent, list() re-raises the first loading error
+                    list(executor.map(self.residency.get, preload_ids))
+                    list(executor.map(self._convert_tflite_model, convert_ids))
+        finally:
+            self.skipped_transform_ids = set()
+        print(f"{len(preload_ids)} models loaded into memory.")
+
+    @staticmethod
+    def _ensure_rgb(image: Image.Image) -> Image.Image:
         if image.mode == "RGBA":
             image = image.convert("RGB")
             print("Converted image from RGBA to RGB")
-        
-        for transform_id in transforms:
-            try:
-                transformation_type = TransformationType(transform_id)
-            except ValueError:
-                raise ValueError(f"Invalid transformation id {transform_id}")
-            transform = Transformations.get_transform_by_id(transformation_type)
-            if not transform:
-                raise ValueError(f"Transformation {transform_id} not found.")
-            image = transform.apply(image)
-            if image is None:
-                return None
         return image
 
 
-    def predict(self, model_id: int, image: Image.Image) -> tf.Tensor:
-        model_data = self.loaded_models.get(model_id)
+    # Transformations of the requested model the gate checks may use, None for the ensemble (model_id=-1, all checks)
+    def _gate_transform_ids(self, model_id: int) -> Optional[list[int]]:
+        if model_id == -1:
+            return None
+        model_data = self.registered_models.get(model_id)
+        if not model_data:
+            raise HTTPException(status_code=404, detail=f"Model {model_id} not found.")
+        return model_data.transforms
+
+    # Runs the hand-presence gate of the requested model on the image. Returns the transformations applied by the gate,
+    # for predict and predict_all, and the reason the image is rejected (None if a hand was found)
+    def check_hand_presence(self, image: Image.Image, model_id: int) -> tuple[dict, Optional[str]]:
+        transformed = {(): self._ensure_rgb(image)}
+        if self.hand_gate is None:
+            return transformed, None
+        return transformed, self.hand_gate.check(transformed, self._gate_transform_ids(model_id))
+
+    # transformed are the transformations already applied to the image, see check_hand_presence
+    def predict(self, model_id: int, image: Image.Image, transformed: Optional[dict] = None) -> np.ndarray:
+        model_data = self.registered_models.get(model_id)
         if not model_data:
             raise HTTPException(status_code=404, detail=f"Model {model_id} not found.")
         
-        image = self._apply_transforms(image, model_data.transforms)
+        image = model_data.pipeline.apply(self._ensure_rgb(image), transformed)
         if image is None:
             return None
-        
+        return self._run_model(model_id, image)
+
+    # Runs the model on an already transformed image, loading the model if it is not in memory
+    def _run_model(self, model_id: int, image) -> np.ndarray:
         try:
-            prediction = model_data.model.predict(image)
-            
-            if settings.debug:
-                try:
-                    image_array = image.squeeze() 
-                    if image_array.dtype != np.uint8:
-                        image_array = (image_array * 255).astype(np.uint8)  
-                    
-                    i = Image.fromarray(image_array)  
-                    i.save("tr_test.jpg") 
-                except Exception as e:
-                    print(f"Error saving transformed image: {str(e)}. Skipping, don't worry.")
+            # The model isn't loaded or run if the request can no longer be answered in time
+            check_deadline()
+            start = time.perf_counter()
+            resident = self.residency.get(model_id)
+            # Loading a cold model (or waiting for another request to load it) isn't charged to the request
+            extend_deadline(time.perf_counter() - start)
+            start = time.perf_counter()
+            prediction = resident.predict(image)
+            seconds = time.perf_counter() - start
+            FORWARD_SECONDS.labels(str(model_id)).observe(seconds)
+            record(f"model_{model_id}", seconds)
+            capture(f"model_{model_id}_input", image)
+            capture(f"model_{model_id}_output", prediction)
+        except HTTPException:
+            raise
         except Exception as e:
             raise Exception(f"Error predicting with model {model_id}: {str(e)}")
         return prediction
     
+    # Resolution the upload has to be decoded at for the model (the shorter side), None for full resolution.
+    # model_id -1 is the ensemble of all loaded models
+    def decode_size(self, model_id: int) -> Optional[int]:
+        if model_id == -1:
+            sizes = [Transformations.required_input_size(model_data.transforms) for model_data in self.registered_models.values()]
+            if not sizes:
+                return None
+        else:
+            model_data = self.registered_models.get(model_id)
+            if not model_data:
+                raise HTTPException(status_code=404, detail=f"Model {model_id} not found.")
+            sizes = [Transformations.required_input_size(model_data.transforms)]
+        # The checks of the hand-presence gate run on the decoded image as well
+        if self.hand_gate is not None:
+            sizes += self.hand_gate.input_sizes(self._gate_transform_ids(model_id))
+        if None in sizes:
+            return None
+        return max(sizes)
+
+    # Key of the prediction cache for the upload, model_id -1 is the ensemble of all loaded models
+    def prediction_cache_key(self, model_id: int, content: bytes) -> tuple:
+        if model_id == -1:
+            version = tuple((registered_id, model_data.version) for registered_id, model_data in self.registered_models.items())
+        else:
+            model_data = self.registered_models.get(model_id)
+            if not model_data:
+                raise HTTPException(status_code=404, detail=f"Model {model_id} not found.")
+            version = model_data.version
+        return (PredictionCache.digest(content), model_id, version)
+
+    # Batch size and queue time statistics of the batching queues of the models and the U-Net segmentation
+    def batching_stats(self) -> Dict[object, dict]:
+        stats = {
+            model_id: resident.batching_queue.stats.snapshot()
+            for model_id, resident in self.residency.resident_items()
+            if resident.batching_queue is not None
+        }
+        unet = Transformations.get_transform(TransformationType.U_NET.value)
+        if unet.batching_queue is not None:
+            stats["unet"] = unet.batching_queue.stats.snapshot()
+        return stats
+    
     def _vote_predictions(self, predictions: Dict[int, GestureType]) -> GestureType:
         votes = {}
         for model_id, prediction in predictions.items():
@@ -100,20 +329,29 @@ class ModelManager:
                 votes[prediction] += 1
         return max(votes, key=votes.get)
     
-    def predict_all(self, image: Image.Image):
-        predictions = {}
-        if not self.loaded_models:
+    # transformed are the transformations already applied to the image, see check_hand_presence
+    # Returns the elected gesture and whether it is partial: decided by the models that voted before the deadline ran out
+    def predict_all(self, image: Image.Image, transformed: Optional[dict] = None) -> tuple[Optional[GestureType], bool]:
+        if not self.registered_models:
             raise Exception("No models loaded.")
         
-        for model_id, model_data in self.loaded_models.items():
-            prediction = self.predict(model_id, image)
-            if prediction is not None:
-                predictions[model_id] = GestureType(np.argmax(prediction))
+        image = self._ensure_rgb(image)
+        transformed = transformed if transformed is not None else {(): image}
+        if settings.ensemble_mode == "cascade":
+            predictions, elected, partial = self._predict_all_cascade(image, transformed)
+        else:
+            if settings.ensemble_parallel:
+                predictions, partial = self._predict_all_parallel(image, transformed)
+            else:
+                predictions, partial = self._predict_all_sequential(image, transformed)
+            elected = None
                 
         if not predictions:
-            return None
+            return None, partial
 
-        elected = self._vote_predictions(predictions)
+        if elected is None:
+            with timed_stage("vote"):
+                elected = self._vote_predictions(predictions)
         
         if settings.debug:
             print("Predictions:")
@@ -121,6 +359,118 @@ class ModelManager:
                 print(f" Model {model_id}\t-\t{str(prediction)}")
             print(f"Elected: {str(elected)}")
             
-        return elected
-        
-        
\ No newline at end of file
+        return elected, partial
+
+    def _predict_model_input(self, model_id: int, model_input) -> Optional[GestureType]:
+        if model_input is None:
+            return None
+        model_input = self.registered_models[model_id].pipeline.finish(model_input)
+        prediction = self._run_model(model_id, model_input)
+        if prediction is None:
+            return None
+        return GestureType(np.argmax(prediction))
+
+    def _predict_all_sequential(self, image: Image.Image, transformed: dict) -> tuple[Dict[int, GestureType], bool]:
+        predictions = {}
+        # Shared transformation prefixes are applied only once for all models
+        model_inputs = self.transformation_tree.apply(image, transformed)
+        for model_id in self.registered_models:
+            try:
+                prediction = self._predict_model_input(model_id, model_inputs.get(model_id))
+            except HTTPException as e:
+                # Out of time, the models that already voted decide
+                if e.status_code != 504 or not predictions:
+                    raise
+                return predictions, True
+            if prediction is not None:
+                predictions[model_id] = prediction
+        return predictions, False
+
+    # Runs the branches of the transformation tree and the models concurrently on the ensemble executor.
+    # Returns as soon as the vote is decided, the models that did not start yet are skipped
+    def _predict_all_parallel(self, image: Image.Image, transformed: dict) -> tuple[Dict[int, GestureType], bool]:
+        vote = EnsembleVote(self.registered_models.keys(), early_exit=settings.ensemble_early_exit)
+        futures = []
+
+        def run_job(fn, *args):
+            try:
+                fn(*args)
+            except Exception as e:
+                vote.fail(e)
+
+        def submit(fn, *args):
+            if vote.done.is_set():
+                return
+            context = contextvars.copy_context()
+            futures.append(self.ensemble_executor.submit(context.run, run_job, fn, *args))
+
+        def on_result(model_id: int, model_input):
+            if vote.done.is_set():
+                return
+            try:
+                prediction = self._predict_model_input(model_id, model_input)
+            except HTTPException as e:
+                if e.status_code != 504:
+                    raise
+                vote.expire(model_id, e)
+                return
+            vote.add(model_id, prediction)
+
+        self.transformation_tree.apply_parallel(image, submit, on_result, vote.done.is_set, transformed)
+        vote.done.wait()
+        for future in futures:
+            future.cancel()
+        if vote.error is not None:
+            raise vote.error
+        # Out of time, the models that already voted decide. Without any vote the request fails with 504
+        if vote.expired is not None and not vote.predictions:
+            raise vote.expired
+
+        # Keep the order of the models, so ties are resolved the same way as in the sequential mode
+        predictions = {model_id: vote.predictions[model_id] for model_id in self.registered_models if model_id in vote.predictions}
+        return predictions, vote.expired is not None
+
+    # Accuracy of the model from its statistics, smoothed towards the prior accuracy while it has few predictions
+    @staticmethod
+    def _model_accuracy(statistics: tuple[int, int]) -> float:
+        total, wrong = statistics
+        return (total - wrong + settings.cascade_prior_accuracy * settings.cascade_prior_weight) / (total + settings.cascade_prior_weight)
+
+    # Expected time to get the prediction of the model, the transformations already applied for this request are free
+    def _cascade_cost(self, model_id: int, transformed: Dict[tuple, object]) -> float:
+        default_cost = settings.cascade_default_cost_ms / 1000
+        pipeline = self.registered_models[model_id].pipeline
+        names = [TransformationType(transform_id).name.lower() for transform_id in pipeline.image_transform_ids[pipeline.applied_prefix(transformed):]]
+        names += ["fused_tensor_preparation", f"model_{model_id}"]
+        return sum(cost if (cost := MEAN_SECONDS.get(name)) is not None else default_cost for name in names)
+
+    # Runs the models one at a time, each time the one with the lowest cost per accuracy above chance.
+    # Stops once the weighted vote is confident enough, expensive models (ResNet-50, U-Net) run only when it isn't
+    def _predict_all_cascade(self, image: Image.Image, transformed: dict) -> tuple[Dict[int, GestureType], Optional[GestureType], bool]:
+        statistics = StatisticsBuffer().totals()
+        accuracy = {model_id: self._model_accuracy(statistics.get(model_id, (0, 0))) for model_id in self.registered_models}
+        vote = CascadeVote(settings.cascade_confidence_threshold)
+        remaining = list(self.registered_models)
+        models_run = 0
+        partial = False
+        while remaining and not vote.done(sum(accuracy[model_id] for model_id in remaining)):
+            model_id = min(remaining, key=lambda model_id: self._cascade_cost(model_id, transformed) / max(accuracy[model_id] - 1 / 3, 0.01))
+            remaining.remove(model_id)
+            model_input = self.registered_models[model_id].pipeline.transform(transformed)
+            if model_input is None:
+                continue
+            models_run += 1
+            try:
+                prediction = self._run_model(model_id, self.registered_models[model_id].pipeline.finish(model_input))
+            except HTTPException as e:
+                # Out of time, the models that already voted decide
+                if e.status_code != 504 or not vote.predictions:
+                    raise
+                partial = True
+                break
+            if prediction is not None:
+                vote.add(model_id, prediction, accuracy[model_id])
+        CASCADE_MODELS.observe(models_run)
+        # Keep the order of the models, like the other ensemble modes
+        predictions = {model_id: vote.predictions[model_id] for model_id in self.registered_models if model_id in vote.predictions}
+        return predictions, vote.elected(), partial
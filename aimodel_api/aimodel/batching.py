@@ -0,0 +1,155 @@
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+from typing import Callable, Dict
+
+import numpy as np
+
+
+# Batch size and queue time statistics of a single batching queue
+class BatchingStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.batch_sizes: Dict[int, int] = {}
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+
+    def record(self, batch_size: int, queue_times: list[float]):
+        with self._lock:
+            self.batches += 1
+            self.requests += len(queue_times)
+            self.batch_sizes[batch_size] = self.batch_sizes.get(batch_size, 0) + 1
+            self.queue_time_total += sum(queue_times)
+            self.queue_time_max = max(self.queue_time_max, max(queue_times))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "requests": self.requests,
+                "avg_batch_size": self.requests / self.batches if self.batches else 0.0,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "avg_queue_time_ms": 1000 * self.queue_time_total / self.requests if self.requests else 0.0,
+                "max_queue_time_ms": 1000 * self.queue_time_max,
+            }
+
+
+class _BatchRequest:
+    __slots__ = ("inputs", "future", "enqueued_at")
+
+    def __init__(self, inputs: np.ndarray):
+        self.inputs = inputs
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+# Collects concurrent requests to a single model and runs them as one stacked forward pass.
+# A batch is run when max_batch_size samples are collected or max_wait_ms passed since the first request arrived,
+# or as soon as the queue is empty and no other caller is inside the model - a lone request doesn't wait.
+# Inputs must already have the batch dimension, results are split back and returned to every caller
+class BatchingQueue:
+    def __init__(self, name: str, predict_fn: Callable[[np.ndarray], np.ndarray], max_batch_size: int = 16, max_wait_ms: float = 5.0):
+        if max_batch_size < 1:
+            raise ValueError("BatchingQueue: max_batch_size must be at least 1.")
+        self.name = name
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.stats = BatchingStats()
+
+        self._queue: Queue = Queue()
+        self._closed = False
+        self._close_lock = threading.Lock()
+        # Callers that submitted a request and didn't get the result yet
+        self._inside = 0
+        self._inside_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=f"batching-{name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, inputs: np.ndarray) -> Future:
+        request = _BatchRequest(np.asarray(inputs))
+        with self._close_lock:
+            if not self._closed:
+                with self._inside_lock:
+                    self._inside += 1
+                request.future.add_done_callback(self._leave)
+                self._queue.put(request)
+                return request.future
+        # Queue was closed (e.g. models reloaded) - run the request directly
+        self._run_batch([request])
+        return request.future
+
+    def predict(self, inputs: np.ndarray) -> np.ndarray:
+        return self.submit(inputs).result()
+
+    def _leave(self, _):
+        with self._inside_lock:
+            self._inside -= 1
+
+    def close(self):
+        with self._close_lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+
+    def _collect(self, first: _BatchRequest) -> tuple[list[_BatchRequest], bool]:
+        batch = [first]
+        size = len(first.inputs)
+        deadline = first.enqueued_at + self.max_wait
+        while size < self.max_batch_size:
+            try:
+                request = self._queue.get_nowait()
+            except Empty:
+                # Only wait for callers that are already inside the model but not queued yet
+                with self._inside_lock:
+                    others = self._inside - len(batch)
+                timeout = deadline - time.perf_counter()
+                if others <= 0 or timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except Empty:
+                    break
+            if request is None:
+                return batch, True
+            batch.append(request)
+            size += len(request.inputs)
+        return batch, False
+
+    def _run(self):
+        closed = False
+        while not closed:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, closed = self._collect(first)
+            started_at = time.perf_counter()
+            self.stats.record(len(batch), [started_at - request.enqueued_at for request in batch])
+
+            # Requests of different shapes (should not happen for a single model) are run as separate batches
+            groups: Dict[tuple, list[_BatchRequest]] = {}
+            for request in batch:
+                groups.setdefault((request.inputs.shape[1:], request.inputs.dtype), []).append(request)
+            for requests in groups.values():
+                self._run_batch(requests)
+
+    def _run_batch(self, requests: list[_BatchRequest]):
+        try:
+            if len(requests) == 1:
+                outputs = self.predict_fn(requests[0].inputs)
+            else:
+                outputs = self.predict_fn(np.concatenate([request.inputs for request in requests], axis=0))
+            outputs = np.asarray(outputs)
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+            return
+
+        offset = 0
+        for request in requests:
+            count = len(request.inputs)
+            request.future.set_result(outputs[offset:offset + count])
+            offset += count
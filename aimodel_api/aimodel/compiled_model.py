@@ -0,0 +1,37 @@
+import numpy as np
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import tensorflow as tf
+
+
+# Wraps a Keras model in a tf.function traced once for a fixed input signature (any batch size, float32).
+# Calling it skips the data adapter and callbacks set up by model.predict on every call,
+# which dominate the cost of predicting a single sample.
+# With traced=False the model is called eagerly, tf.function graphs can't run in processes forked after TF started
+class CompiledModel:
+    def __init__(self, keras_model: "tf.keras.models.Model", traced: bool = True):
+        import tensorflow as tf
+
+        self.keras_model = keras_model
+        self.input_shape = tuple(keras_model.input_shape[1:])
+        if not traced:
+            self._forward = self._call
+            return
+        self._forward = tf.function(
+            self._call,
+            input_signature=[tf.TensorSpec(shape=(None, *self.input_shape), dtype=tf.float32)],
+        )
+
+    def _call(self, inputs):
+        return self.keras_model(inputs, training=False)
+
+    # Traces the function with a dummy batch, so the first real request doesn't pay for tracing
+    def warm_up(self):
+        if any(dim is None for dim in self.input_shape):
+            return
+        self(np.zeros((1, *self.input_shape), dtype=np.float32))
+
+    def __call__(self, inputs: np.ndarray) -> np.ndarray:
+        inputs = np.asarray(inputs, dtype=np.float32)
+        return self._forward(inputs).numpy()
@@ -0,0 +1,92 @@
+import threading
+from collections import Counter
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+from ..models import GestureType
+
+
+# Collects the votes of the ensemble models as they finish.
+# done is set when all models voted or, with early_exit, as soon as one gesture has a majority
+# the pending models can no longer beat - the elected gesture is then the same as with all votes counted.
+# It's also set when the deadline of the request passes, the votes collected so far are then all there is
+class EnsembleVote:
+    def __init__(self, model_ids: Iterable[int], early_exit: bool = True):
+        self.early_exit = early_exit
+        self.pending = set(model_ids)
+        self.predictions: Dict[int, GestureType] = {}
+        self.error: Optional[BaseException] = None
+        # Error of the first model that ran out of time (504)
+        self.expired: Optional[BaseException] = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        if not self.pending:
+            self.done.set()
+
+    # Records the vote of a model, None if the model could not predict (e.g. no hand detected)
+    def add(self, model_id: int, prediction: Optional[GestureType]):
+        with self._lock:
+            self.pending.discard(model_id)
+            if prediction is not None:
+                self.predictions[model_id] = prediction
+            if not self.pending or (self.early_exit and self._has_unbeatable_majority()):
+                self.done.set()
+
+    def expire(self, model_id: int, error: BaseException):
+        with self._lock:
+            self.pending.discard(model_id)
+            if self.expired is None:
+                self.expired = error
+            self.done.set()
+
+    def fail(self, error: BaseException):
+        with self._lock:
+            if self.error is None:
+                self.error = error
+            self.done.set()
+
+    def _has_unbeatable_majority(self) -> bool:
+        counts = sorted(Counter(self.predictions.values()).values(), reverse=True)
+        if not counts:
+            return False
+        runner_up = counts[1] if len(counts) > 1 else 0
+        return counts[0] > runner_up + len(self.pending)
+
+
+# Weighted votes of the cascade ensemble. A model votes for its top class with the weight
+# softmax margin (top-1 minus top-2 probability) x historical accuracy of the model.
+# done is set once the lead of the elected gesture reaches the threshold, or when the models that did not run yet
+# could not change the elected gesture even if each voted with full weight
+class CascadeVote:
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.predictions: Dict[int, GestureType] = {}
+        self.scores: Dict[GestureType, float] = {}
+
+    def add(self, model_id: int, probabilities: np.ndarray, accuracy: float):
+        probabilities = np.asarray(probabilities).ravel()
+        top = np.sort(probabilities)[::-1]
+        margin = float(top[0] - top[1]) if top.size > 1 else float(top[0])
+        prediction = GestureType(int(np.argmax(probabilities)))
+        self.predictions[model_id] = prediction
+        self.scores[prediction] = self.scores.get(prediction, 0.0) + margin * accuracy
+
+    # Lead of the elected gesture over the runner-up
+    def confidence(self) -> float:
+        scores = sorted(self.scores.values(), reverse=True)
+        if not scores:
+            return 0.0
+        return scores[0] - (scores[1] if len(scores) > 1 else 0.0)
+
+    def done(self, remaining_weight: float) -> bool:
+        if not self.scores:
+            return False
+        confidence = self.confidence()
+        return confidence >= self.threshold or confidence > remaining_weight
+
+    # Gesture with the highest score, ties are resolved by the order of the votes
+    def elected(self) -> Optional[GestureType]:
+        if not self.scores:
+            return None
+        return max(self.scores, key=self.scores.get)
@@ -0,0 +1,202 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future
+from contextvars import ContextVar
+from typing import Callable, Mapping, Optional
+from fastapi import HTTPException
+
+from ..config import settings
+
+# Time budget of the request in milliseconds, counted from when the endpoint starts handling it
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
+# Deadline (time.monotonic()) of the request the current job belongs to, None if it has none
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+# Deadline of the request from the DEADLINE_HEADER header, or default_ms (0 - no deadline)
+def deadline_from_headers(headers: Mapping[str, str], default_ms: float) -> Optional[float]:
+    value = headers.get(DEADLINE_HEADER)
+    if value is None:
+        return time.monotonic() + default_ms / 1000 if default_ms > 0 else None
+    try:
+        budget_ms = float(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {DEADLINE_HEADER} header")
+    if not math.isfinite(budget_ms):
+        raise HTTPException(status_code=400, detail=f"Invalid {DEADLINE_HEADER} header")
+    return time.monotonic() + budget_ms / 1000
+
+
+def _deadline_exceeded() -> HTTPException:
+    return HTTPException(status_code=504, detail="Deadline of the request exceeded.")
+
+
+# Raises 504 if the deadline of the current request passed, called before the expensive steps (e.g. the forward pass)
+def check_deadline():
+    deadline = request_deadline.get()
+    if deadline is not None and time.monotonic() > deadline:
+        raise _deadline_exceeded()
+
+
+# Moves the deadline of the current request, for time that isn't charged to it (e.g. loading a cold model)
+def extend_deadline(seconds: float):
+    deadline = request_deadline.get()
+    if deadline is not None:
+        request_deadline.set(deadline + seconds)
+
+
+class _Job:
+    __slots__ = ("fn", "args", "context", "future", "deadline")
+
+    def __init__(self, fn: Callable, args: tuple, deadline: Optional[float]):
+        self.fn = fn
+        self.args = args
+        self.deadline = deadline
+        # The job runs with the context of the submitter and the deadline of its request
+        self.context = contextvars.copy_context()
+        self.context.run(request_deadline.set, deadline)
+        self.future = Future()
+
+    # Jobs without a deadline are run after the jobs with one, in the order of submission
+    def sort_key(self) -> float:
+        return self.deadline if self.deadline is not None else math.inf
+
+
+# Runs blocking inference jobs on a dedicated pool of worker threads, away from the event loop.
+# At most inference_workers jobs run at once and inference_queue_size jobs wait. Waiting jobs run earliest deadline first.
+# When the queue is full, a job with an earlier deadline than the latest queued one takes its place (the latest one
+# is shed with 503), otherwise the submission is rejected right away with 503 and a Retry-After header.
+# Jobs whose deadline passed before they started fail with 504 without running
+class InferenceExecutor:
+    _instance = None
+
+    # Singleton
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(InferenceExecutor, cls).__new__(cls, *args, **kwargs)
+            cls._instance._reset_after_fork()
+            cls._instance.completed = 0
+            cls._instance.rejected = 0
+            cls._instance.shed = 0
+            cls._instance.expired = 0
+            os.register_at_fork(after_in_child=cls._instance._reset_after_fork)
+        return cls._instance
+
+    # Worker threads don't survive fork, forked workers start their own
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._job_ready = threading.Condition(self._lock)
+        # Heap of (deadline, sequence number, job)
+        self._queue = []
+        self._sequence = itertools.count()
+        self._workers = []
+        self._stopping = False
+        self._running = 0
+
+    def start(self):
+        with self._lock:
+            if self._workers:
+                return
+            self._stopping = False
+            self._workers = [
+                threading.Thread(target=self._work, name=f"inference-{i}", daemon=True)
+                for i in range(settings.inference_workers)
+            ]
+            for worker in self._workers:
+                worker.start()
+        print(f"Inference executor started with {settings.inference_workers} workers.")
+
+    # The queued jobs are run before the workers stop
+    def shutdown(self):
+        with self._lock:
+            if not self._workers:
+                return
+            workers, self._workers = self._workers, []
+            self._stopping = True
+            self._job_ready.notify_all()
+        for worker in workers:
+            worker.join()
+
+    def submit(self, fn: Callable, *args, deadline: Optional[float] = None) -> Future:
+        self.start()
+        job = _Job(fn, args, deadline)
+        shed_job = None
+        with self._lock:
+            if deadline is not None and time.monotonic() > deadline:
+                self.expired += 1
+                raise _deadline_exceeded()
+            if len(self._queue) >= settings.inference_queue_size:
+                latest = max(self._queue)
+                if latest[0] <= job.sort_key():
+                    self.rejected += 1
+                    raise self._busy()
+                self._queue.remove(latest)
+                heapq.heapify(self._queue)
+                shed_job = latest[2]
+                self.shed += 1
+            heapq.heappush(self._queue, (job.sort_key(), next(self._sequence), job))
+            self._job_ready.notify()
+        if shed_job is not None:
+            shed_job.future.set_exception(self._busy())
+        return job.future
+
+    @staticmethod
+    def _busy() -> HTTPException:
+        return HTTPException(
+            status_code=503,
+            detail="Server is busy, try again later.",
+            headers={"Retry-After": str(settings.inference_retry_after_s)},
+        )
+
+    # Runs fn(*args) on the executor and awaits the result without blocking the event loop
+    async def run(self, fn: Callable, *args, deadline: Optional[float] = None):
+        return await asyncio.wrap_future(self.submit(fn, *args, deadline=deadline))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": len(self._workers),
+                "running": self._running,
+                "queued": len(self._queue),
+                "queue_size": settings.inference_queue_size,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "shed": self.shed,
+                "expired": self.expired,
+            }
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._stopping:
+                    self._job_ready.wait()
+                if not self._queue:
+                    break
+                _, _, job = heapq.heappop(self._queue)
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            # Expired while waiting, dropped before any preprocessing
+            if job.deadline is not None and time.monotonic() > job.deadline:
+                with self._lock:
+                    self.expired += 1
+                job.future.set_exception(_deadline_exceeded())
+                continue
+            with self._lock:
+                self._running += 1
+            try:
+                result = job.context.run(job.fn, *job.args)
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self.completed += 1
@@ -0,0 +1,52 @@
+from typing import Dict, Iterable, Optional
+
+from ..metrics import HAND_GATE_TOTAL, timed_stage
+from .pipeline import CompiledPipeline
+from .transformations import Transformations
+
+# Reason of a prediction=None response when the gate found no hand
+NO_HAND_REASON = "no_hand_detected"
+
+
+# Hand-presence check that runs once per request, before the classifier pipelines.
+# The checks are hand detection transformations (MediaPipe, then U-Net), each applied with the shortest chain
+# the registered models use for it, e.g. rotate -> resize -> mp_hands. Their outputs are kept in transformed,
+# so the pipelines of the request continue from them instead of applying the chain again.
+# A hand found by any check passes the image, if none finds one the request is answered without running the models.
+# A request for a single model only runs the checks of the transformations in the chain of the model, which it would run anyway
+class HandPresenceGate:
+    def __init__(self, chains: list[list[int]]):
+        self.checks = [CompiledPipeline(chain) for chain in chains]
+
+    # Checks of the request, all of them if transform_ids is None (the ensemble)
+    def checks_for(self, transform_ids: Optional[Iterable[int]] = None) -> list[CompiledPipeline]:
+        if transform_ids is None:
+            return self.checks
+        transform_ids = set(transform_ids)
+        return [check for check in self.checks if check.transform_ids[-1] in transform_ids]
+
+    # Image sizes the checks of the request need, see Transformations.required_input_size
+    def input_sizes(self, transform_ids: Optional[Iterable[int]] = None) -> list[Optional[int]]:
+        return [Transformations.required_input_size(check.transform_ids) for check in self.checks_for(transform_ids)]
+
+    # Checks of the given transformations with the chains of the models, a transformation no model uses runs on the image
+    @classmethod
+    def from_chains(cls, model_chains: Dict[int, list[int]], transform_ids: list[int]) -> "HandPresenceGate":
+        chains = []
+        for transform_id in transform_ids:
+            prefixes = [chain[:chain.index(transform_id) + 1] for chain in model_chains.values() if transform_id in chain]
+            chains.append(min(prefixes, key=len) if prefixes else [transform_id])
+        return cls(chains)
+
+    # Returns the reason the image is rejected, None if a hand was found (or the request has no checks)
+    def check(self, transformed: dict, transform_ids: Optional[Iterable[int]] = None) -> Optional[str]:
+        checks = self.checks_for(transform_ids)
+        if not checks:
+            return None
+        with timed_stage("hand_gate"):
+            for check in checks:
+                if check.transform(transformed) is not None:
+                    HAND_GATE_TOTAL.labels("hand").inc()
+                    return None
+        HAND_GATE_TOTAL.labels("no_hand").inc()
+        return NO_HAND_REASON
@@ -0,0 +1,46 @@
+import math
+from io import BytesIO
+from typing import Optional
+from PIL import Image, ImageOps
+from fastapi import HTTPException
+
+from ..config import settings
+
+
+# Decodes an uploaded image at the smallest resolution whose shorter side is at least min_size
+# (full resolution if None), applying the EXIF orientation.
+# JPEGs are decoded directly at a reduced scale (1/2, 1/4 or 1/8), other formats are reduced right after decoding
+def decode_image(content: bytes, min_size: Optional[int] = None) -> Image.Image:
+    if len(content) > settings.max_upload_bytes:
+        raise HTTPException(status_code=413, detail="Image file is too large")
+    try:
+        image = Image.open(BytesIO(content))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    if image.width * image.height > settings.max_image_pixels:
+        raise HTTPException(status_code=413, detail="Image resolution is too large")
+
+    try:
+        reduce_factor = _reduce_factor(image.size, min_size)
+        if reduce_factor > 1 and image.format == "JPEG":
+            image.draft(image.mode, _reduced_size(image.size, min_size))
+            reduce_factor = _reduce_factor(image.size, min_size)
+        image.load()
+        if reduce_factor > 1:
+            image = image.reduce(reduce_factor)
+        image = ImageOps.exif_transpose(image)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    return image
+
+
+def _reduce_factor(size: tuple[int, int], min_size: Optional[int]) -> int:
+    if not settings.reduced_decoding or min_size is None:
+        return 1
+    return max(1, min(size) // min_size)
+
+
+# Size with the same aspect ratio whose shorter side is min_size
+def _reduced_size(size: tuple[int, int], min_size: int) -> tuple[int, int]:
+    scale = min_size / min(size)
+    return math.ceil(size[0] * scale), math.ceil(size[1] * scale)
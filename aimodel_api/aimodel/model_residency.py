@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable
+
+from .batching import BatchingQueue
+
+
+# Model held in memory: the Keras model, its forward pass and the batching queue in front of it
+class ResidentModel:
+    def __init__(self, model, predict_fn: Callable, batching_queue: BatchingQueue = None, size_bytes: int = 0):
+        self.model = model
+        self.predict_fn = predict_fn
+        self.batching_queue = batching_queue
+        self.size_bytes = size_bytes
+
+    # Runs the forward pass, through the batching queue if batching is enabled
+    def predict(self, inputs):
+        if self.batching_queue is not None:
+            return self.batching_queue.predict(inputs)
+        return self.predict_fn(inputs)
+
+    def close(self):
+        if self.batching_queue is not None:
+            self.batching_queue.close()
+
+
+# Keeps models in memory within a memory budget. Models are loaded on first use with loader(key),
+# when the budget is exceeded the least recently used models that are not pinned are evicted.
+# A budget of 0 means no limit
+class ModelResidency:
+    def __init__(self, loader: Callable[[Hashable], ResidentModel], budget_bytes: int = 0):
+        self.loader = loader
+        self.budget_bytes = budget_bytes
+        self.pinned: set = set()
+        self.loads = 0
+        self.evictions = 0
+        self._resident: "OrderedDict[Hashable, ResidentModel]" = OrderedDict()
+        self._load_locks: Dict[Hashable, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> ResidentModel:
+        with self._lock:
+            resident = self._resident.get(key)
+            if resident is not None:
+                self._resident.move_to_end(key)
+                return resident
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Only one thread loads a model, the others wait for it
+        with load_lock:
+            with self._lock:
+                resident = self._resident.get(key)
+                if resident is not None:
+                    self._resident.move_to_end(key)
+                    return resident
+            resident = self.loader(key)
+            with self._lock:
+                self._resident[key] = resident
+                self.loads += 1
+                evicted = self._evict(keep=key)
+        for model in evicted:
+            model.close()
+        return resident
+
+    def is_resident(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._resident
+
+    def resident_items(self) -> list[tuple[Hashable, ResidentModel]]:
+        with self._lock:
+            return list(self._resident.items())
+
+    def clear(self):
+        with self._lock:
+            evicted = list(self._resident.values())
+            self._resident.clear()
+            self._load_locks.clear()
+        for model in evicted:
+            model.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "resident": list(self._resident.keys()),
+                "pinned": sorted(self.pinned),
+                "resident_bytes": sum(model.size_bytes for model in self._resident.values()),
+                "budget_bytes": self.budget_bytes,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+    def _evict(self, keep: Hashable) -> list[ResidentModel]:
+        evicted = []
+        if self.budget_bytes <= 0:
+            return evicted
+        total = sum(model.size_bytes for model in self._resident.values())
+        for key in list(self._resident.keys()):
+            if total <= self.budget_bytes:
+                break
+            if key == keep or key in self.pinned:
+                continue
+            model = self._resident.pop(key)
+            total -= model.size_bytes
+            self.evictions += 1
+            evicted.append(model)
+        return evicted
@@ -0,0 +1,188 @@
+import threading
+import time
+import numpy as np
+from PIL import Image
+from typing import Optional
+
+from ..config import settings
+from ..metrics import TRANSFORM_SECONDS, record
+from .transformations import Transformations, TransformationType
+
+# Transformations that only turn the final image into the model input, they are fused into one step
+TENSOR_TRANSFORMS = {
+    TransformationType.NORMALIZE.value,
+    TransformationType.ADD_GRAYSCALE_CHANNEL.value,
+    TransformationType.ADD_BATCH_DIM.value,
+    TransformationType.RESNET_PREPROCESS.value,
+}
+
+# Mean pixel values (BGR) subtracted by the ResNet50 preprocessing
+RESNET_MEAN = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+
+# Synthetic image used by the dry run
+DRY_RUN_IMAGE_SIZE = (640, 480)
+
+
+# Fused tensor preparation (normalize, resnet preprocess, add channel, add batch dim).
+# The image is written in a single pass into a float32 input buffer, preallocated per thread and reused for every request.
+# The channel and batch dimensions have size 1, so the buffer is just reshaped to the shape of the image
+class FusedTensorPreparation:
+    def __init__(self, transform_ids: list[int]):
+        self.transform_ids = transform_ids
+        self.value_ops = []
+        self.expand_ops = []
+        for transform_id in transform_ids:
+            if transform_id == TransformationType.NORMALIZE.value:
+                self.value_ops.append(self._normalize)
+            elif transform_id == TransformationType.RESNET_PREPROCESS.value:
+                self.value_ops.append(self._resnet_preprocess)
+            elif transform_id == TransformationType.ADD_GRAYSCALE_CHANNEL.value:
+                self.expand_ops.append(-1)
+            elif transform_id == TransformationType.ADD_BATCH_DIM.value:
+                self.expand_ops.append(0)
+            else:
+                raise ValueError(f"Transformation {transform_id} can't be fused.")
+        self._local = threading.local()
+
+    def output_shape(self, shape: tuple) -> tuple:
+        for axis in self.expand_ops:
+            shape = (1, *shape) if axis == 0 else (*shape, 1)
+        return shape
+
+    # The returned array is the buffer of the calling thread, it's overwritten by the next call in the same thread
+    def apply(self, image) -> np.ndarray:
+        image = np.asarray(image)
+        output_shape = self.output_shape(image.shape)
+        buffer = self._buffer(output_shape)
+        out = buffer.reshape(image.shape)
+        if not self.value_ops:
+            np.copyto(out, image, casting="unsafe")
+        source = image
+        for value_op in self.value_ops:
+            value_op(source, out)
+            source = out
+        return buffer
+
+    def _buffer(self, shape: tuple) -> np.ndarray:
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        buffer = buffers.get(shape)
+        if buffer is None:
+            buffer = buffers[shape] = np.empty(shape, dtype=np.float32)
+        return buffer
+
+    @staticmethod
+    def _normalize(source: np.ndarray, out: np.ndarray):
+        np.divide(source, np.float32(255.0), out=out, casting="unsafe")
+
+    @staticmethod
+    def _resnet_preprocess(source: np.ndarray, out: np.ndarray):
+        # RGB -> BGR, then the mean is subtracted (caffe mode), in place the flipped view must be copied first
+        flipped = source[..., ::-1]
+        if source is out:
+            flipped = flipped.copy()
+        np.subtract(flipped, RESNET_MEAN, out=out, casting="unsafe")
+
+
+# Transformation chain of a model, compiled when the model is registered.
+# The leading image transformations (rotate, resize, hand detection, ...) are shared with other models in the
+# transformation tree, the trailing tensor transformations are fused. The pipeline is validated with a dry run
+# on a synthetic image, invalid transformation ids or incompatible steps fail at registration instead of per request
+class CompiledPipeline:
+    def __init__(self, transform_ids: list[int]):
+        self.transform_ids = list(transform_ids)
+        transforms = [Transformations.get_transform(transform_id) for transform_id in self.transform_ids]
+
+        split = len(self.transform_ids)
+        while split > 0 and self.transform_ids[split - 1] in TENSOR_TRANSFORMS:
+            split -= 1
+        self.image_transform_ids = self.transform_ids[:split]
+        self.tensor_transform_ids = self.transform_ids[split:]
+        self.image_transforms = transforms[:split]
+        self.tensor_preparation = FusedTensorPreparation(self.tensor_transform_ids) if self.tensor_transform_ids else None
+        # Shape of the model input, None if it depends on the size of the uploaded image
+        self.output_shape: Optional[tuple] = None
+        self._dry_run()
+
+    # Checks the chain on a synthetic image and compares the fused steps with the separate transformations
+    def _dry_run(self):
+        rng = np.random.default_rng(0)
+        image = Image.fromarray(rng.integers(0, 256, (DRY_RUN_IMAGE_SIZE[1], DRY_RUN_IMAGE_SIZE[0], 3), dtype=np.uint8))
+        try:
+            for transform in self.image_transforms:
+                image = transform.dry_run(image)
+            reference = image
+            for transform_id in self.tensor_transform_ids:
+                reference = Transformations.get_transform(transform_id).apply(reference)
+            fused = self.tensor_preparation.apply(image) if self.tensor_preparation is not None else image
+        except Exception as e:
+            raise ValueError(f"Invalid transformations {self.transform_ids}: {str(e)}")
+
+        reference = np.asarray(reference)
+        fused = np.asarray(fused)
+        if fused.shape != reference.shape or not np.allclose(fused, reference.astype(np.float32), atol=1e-4):
+            raise ValueError(f"Invalid transformations {self.transform_ids}: fused tensor preparation doesn't match the transformations.")
+        if Transformations.required_input_size(self.transform_ids) is not None:
+            self.output_shape = fused.shape
+
+    # Applies the whole chain to the image, None if a transformation found nothing (e.g. no hand detected).
+    # transformed are the outputs of the transformation prefixes already applied to the image, see transform
+    def apply(self, image, transformed: Optional[dict] = None) -> Optional[np.ndarray]:
+        image = self.transform(transformed if transformed is not None else {(): image})
+        if image is None:
+            return None
+        return self.finish(image)
+
+    # Length of the longest prefix of the image transformations in transformed
+    def applied_prefix(self, transformed: dict) -> int:
+        applied = len(self.image_transform_ids)
+        while tuple(self.image_transform_ids[:applied]) not in transformed:
+            applied -= 1
+        return applied
+
+    # Applies the image transformations. transformed maps the prefixes of transformation ids already applied to the image
+    # (the empty prefix is the image itself) to their outputs, the chain continues from the longest one.
+    # The prefixes applied here are added to it, so the other pipelines of the request reuse them
+    def transform(self, transformed: dict):
+        applied = self.applied_prefix(transformed)
+        image = transformed[tuple(self.image_transform_ids[:applied])]
+        for i in range(applied, len(self.image_transform_ids)):
+            if image is None:
+                break
+            image = Transformations.apply(self.image_transform_ids[i], image)
+            transformed[tuple(self.image_transform_ids[:i + 1])] = image
+        return image
+
+    # Model input for a calibration image, None if a transformation rejects it (e.g. no hand found).
+    # Returns a copy, the fused buffer is reused
+    def calibration_input(self, image) -> Optional[np.ndarray]:
+        for transform in self.image_transforms:
+            image = transform.apply(image)
+            if image is None:
+                return None
+        return np.array(self.finish(image), dtype=np.float32)
+
+    # Turns the output of the image transformations into the model input
+    def finish(self, image) -> np.ndarray:
+        if self.tensor_preparation is None:
+            return image
+        if not settings.fused_pipelines:
+            for transform_id in self.tensor_transform_ids:
+                image = Transformations.apply(transform_id, image)
+            return image
+        start = time.perf_counter()
+        image = self.tensor_preparation.apply(image)
+        seconds = time.perf_counter() - start
+        TRANSFORM_SECONDS.labels("fused_tensor_preparation").observe(seconds)
+        record("fused_tensor_preparation", seconds)
+        return image
+
+    # Checks that the pipeline produces inputs the model accepts
+    def check_model_input(self, input_shape: tuple):
+        if self.output_shape is None:
+            return
+        if len(input_shape) != len(self.output_shape) or any(
+            expected is not None and expected != actual for expected, actual in zip(input_shape[1:], self.output_shape[1:])
+        ):
+            raise ValueError(f"Transformations {self.transform_ids} produce inputs of shape {self.output_shape}, model expects {input_shape}.")
@@ -0,0 +1,190 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from typing import TYPE_CHECKING, Callable, Optional
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from ..config import settings
+
+# tensorflow is imported on first use, see startup.py
+if TYPE_CHECKING:
+    import tensorflow as tf
+
+QUANTIZATION_MODES = ("none", "dynamic", "int8")
+CALIBRATION_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+# Forward pass of a model converted to TensorFlow Lite. An interpreter can't be called from several threads,
+# every thread gets its own one over the same flatbuffer. The input tensor is resized to the batch size of the call
+class TFLiteModel:
+    def __init__(self, model_content: bytes, num_threads: int = 1):
+        self.model_content = model_content
+        self.num_threads = num_threads
+        self._local = threading.local()
+        self.input_shape = tuple(int(dim) for dim in self._interpreter().get_input_details()[0]["shape_signature"][1:])
+
+    def _interpreter(self) -> "tf.lite.Interpreter":
+        interpreter = getattr(self._local, "interpreter", None)
+        if interpreter is None:
+            import tensorflow as tf
+
+            interpreter = tf.lite.Interpreter(model_content=self.model_content, num_threads=self.num_threads)
+            interpreter.allocate_tensors()
+            self._local.interpreter = interpreter
+        return interpreter
+
+    def warm_up(self):
+        if any(dim < 0 for dim in self.input_shape):
+            return
+        self(np.zeros((1, *self.input_shape), dtype=np.float32))
+
+    def __call__(self, inputs: np.ndarray) -> np.ndarray:
+        inputs = np.asarray(inputs, dtype=np.float32)
+        interpreter = self._interpreter()
+        input_details = interpreter.get_input_details()[0]
+        if tuple(input_details["shape"]) != inputs.shape:
+            interpreter.resize_tensor_input(input_details["index"], inputs.shape)
+            interpreter.allocate_tensors()
+        interpreter.set_tensor(input_details["index"], inputs)
+        interpreter.invoke()
+        return interpreter.get_tensor(interpreter.get_output_details()[0]["index"])
+
+
+# Converts the Keras model to a TFLite flatbuffer. "dynamic" quantizes the weights to int8,
+# "int8" quantizes the weights and activations with ranges calibrated on the samples (inputs and outputs stay float32)
+def convert(keras_model: "tf.keras.models.Model", quantization: str, calibration_samples: list[np.ndarray]) -> bytes:
+    import tensorflow as tf
+
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown TFLite quantization {quantization}, expected one of {QUANTIZATION_MODES}.")
+    # Keras 3 models are converted through an exported SavedModel
+    export_dir = tempfile.mkdtemp(prefix="tflite-export-")
+    try:
+        keras_model.export(export_dir, verbose=False)
+        converter = tf.lite.TFLiteConverter.from_saved_model(export_dir)
+        if quantization != "none":
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == "int8":
+            if not calibration_samples:
+                raise ValueError("int8 quantization needs calibration samples.")
+            converter.representative_dataset = lambda: ([sample] for sample in calibration_samples)
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        return converter.convert()
+    finally:
+        shutil.rmtree(export_dir, ignore_errors=True)
+
+
+# Converted models are cached next to the models folder, the file name changes with the model file and the quantization
+def cache_path(model_version: str, quantization: str) -> str:
+    folder = settings.tflite_cache_folder or os.path.join(settings.ai_models_folder, "tflite_cache")
+    name = os.path.splitext(os.path.basename(model_version.split(":")[0]))[0]
+    digest = hashlib.sha256(model_version.encode()).hexdigest()[:16]
+    return os.path.join(folder, f"{name}.{quantization}.{digest}.tflite")
+
+
+# Images of the calibration folder (settings.tflite_calibration_folder), at most limit of them.
+# They should be real photos of the gestures, the samples are what the pipelines make of them
+def calibration_images(limit: int) -> list[Image.Image]:
+    folder = settings.tflite_calibration_folder
+    if not folder or not os.path.isdir(folder):
+        return []
+    images = []
+    for name in sorted(os.listdir(folder)):
+        if len(images) >= limit:
+            break
+        if not name.lower().endswith(CALIBRATION_EXTENSIONS):
+            continue
+        try:
+            with Image.open(os.path.join(folder, name)) as image:
+                images.append(ImageOps.exif_transpose(image).convert("RGB"))
+        except Exception as e:
+            print(f"Skipping calibration image {name}: {e}")
+    return images
+
+
+# Top-1 class of every sample, the decision the ensemble votes on
+def argmax_decision(outputs: np.ndarray) -> np.ndarray:
+    return np.argmax(outputs.reshape(outputs.shape[0], -1), axis=-1)
+
+
+# Pixels of a segmentation mask, thresholded like the U-Net output
+def mask_decision(outputs: np.ndarray) -> np.ndarray:
+    return outputs > 0.5
+
+
+# Fraction of the decisions of the converted model that match the reference model on the samples
+def agreement(
+    reference_fn: Callable[[np.ndarray], np.ndarray],
+    converted_fn: Callable[[np.ndarray], np.ndarray],
+    samples: list[np.ndarray],
+    decision: Callable[[np.ndarray], np.ndarray],
+) -> float:
+    matches, total = 0, 0
+    for sample in samples:
+        reference = decision(np.asarray(reference_fn(sample)))
+        converted = decision(np.asarray(converted_fn(sample)))
+        matches += int(np.count_nonzero(reference == converted))
+        total += reference.size
+    return matches / total if total else 0.0
+
+
+# Converted forward pass of the model, loaded from the cache or converted and cached.
+# A conversion is only used (and cached) if its decisions agree with the reference forward pass on the calibration samples,
+# the cached file is trusted as it is. calibration_samples returns the model inputs of the calibration images the pipeline
+# accepted, None if they can't be made in this process. Without a cached file and enough samples
+# (settings.tflite_min_calibration_samples) None is returned and the model is served by Keras
+def load_tflite_model(
+    keras_model: "tf.keras.models.Model",
+    model_version: str,
+    reference_fn: Callable[[np.ndarray], np.ndarray],
+    calibration_samples: Callable[[], Optional[list[np.ndarray]]],
+    decision: Callable[[np.ndarray], np.ndarray] = argmax_decision,
+) -> Optional[TFLiteModel]:
+    quantization = settings.tflite_quantization
+    path = cache_path(model_version, quantization)
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                model_content = f.read()
+            tflite_model = TFLiteModel(model_content, num_threads=settings.tflite_threads)
+            print(f"Serving {model_version} with TFLite ({quantization}, cached).")
+            return tflite_model
+        except Exception as e:
+            print(f"Could not load the cached TFLite conversion of {model_version}, converting it again: {e}")
+
+    samples = calibration_samples()
+    if samples is None:
+        print(f"{model_version} can't be calibrated in this process and has no cached TFLite conversion, serving it with Keras.")
+        return None
+    if len(samples) < settings.tflite_min_calibration_samples:
+        print(
+            f"Only {len(samples)} of the calibration images (tflite_calibration_folder) give valid samples for {model_version} "
+            f"(required {settings.tflite_min_calibration_samples}), serving it with Keras."
+        )
+        return None
+    try:
+        model_content = convert(keras_model, quantization, samples)
+        tflite_model = TFLiteModel(model_content, num_threads=settings.tflite_threads)
+    except Exception as e:
+        print(f"Could not convert {model_version} to TFLite ({quantization}), serving it with Keras: {e}")
+        return None
+
+    model_agreement = agreement(reference_fn, tflite_model, samples, decision)
+    if model_agreement < settings.tflite_min_agreement:
+        print(
+            f"TFLite ({quantization}) {model_version} agrees with the Keras model on {model_agreement:.1%} of "
+            f"{len(samples)} calibration samples (required {settings.tflite_min_agreement:.1%}), serving it with Keras."
+        )
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written under a temporary name, so a concurrent loader never reads a partial file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(model_content)
+    os.replace(temp_path, path)
+    print(f"Serving {model_version} with TFLite ({quantization}, {len(model_content) / 1024:.0f} KiB, agreement {model_agreement:.1%}).")
+    return tflite_model
@@ -0,0 +1,89 @@
+from typing import Callable, Dict, Optional
+
+from .transformations import Transformations
+
+
+# Node of the transformation prefix tree. Applies a single transformation to the output of its parent node.
+# Models whose transformation chain ends in this node are kept in model_ids, prefix is the chain from the root to the node
+class TransformationNode:
+    def __init__(self, transform_id: Optional[int] = None, prefix: tuple = ()):
+        self.transform_id = transform_id
+        self.prefix = prefix
+        self.children: Dict[int, "TransformationNode"] = {}
+        self.model_ids: list[int] = []
+
+    # Ids of the models in this node and all nodes below it
+    def subtree_model_ids(self) -> list[int]:
+        model_ids = list(self.model_ids)
+        for child in self.children.values():
+            model_ids.extend(child.subtree_model_ids())
+        return model_ids
+
+
+# Prefix tree of the transformation chains of the loaded models.
+# Chains sharing a prefix (e.g. rotate -> resize) share the nodes, so every shared prefix is applied to the image only once
+class TransformationTree:
+    def __init__(self):
+        self.root = TransformationNode()
+
+    @classmethod
+    def from_chains(cls, chains: Dict[int, list[int]]) -> "TransformationTree":
+        tree = cls()
+        for model_id, transforms in chains.items():
+            tree.add(model_id, transforms)
+        return tree
+
+    def add(self, model_id: int, transforms: list[int]):
+        node = self.root
+        for transform_id in transforms:
+            if transform_id not in node.children:
+                node.children[transform_id] = TransformationNode(transform_id, (*node.prefix, transform_id))
+            node = node.children[transform_id]
+        node.model_ids.append(model_id)
+
+    # Applies all chains to the image, returns the transformed image for every model id.
+    # If a transformation returns None (e.g. no hand detected) all models below that node get None.
+    # Prefixes in transformed (see CompiledPipeline.transform) are not applied again
+    def apply(self, image, transformed: Optional[dict] = None) -> Dict[int, Optional[object]]:
+        transformed = transformed if transformed is not None else {}
+        results = {}
+        stack = [(self.root, image)]
+        while stack:
+            node, node_image = stack.pop()
+            if node.transform_id is not None and node_image is not None:
+                node_image = self._apply_transform(node, node_image, transformed)
+
+            for model_id in node.model_ids:
+                results[model_id] = node_image
+            for child in node.children.values():
+                stack.append((child, node_image))
+        return results
+
+    # Applies the chains concurrently: every node is a separate job passed to submit(fn, *args),
+    # so independent branches (and the models below them) run in parallel.
+    # on_result(model_id, image) is called in the job of the node the model's chain ends in,
+    # stop() is checked before each node is processed so the remaining work can be skipped
+    def apply_parallel(self, image, submit: Callable, on_result: Callable, stop: Callable[[], bool], transformed: Optional[dict] = None):
+        transformed = transformed if transformed is not None else {}
+        submit(self._apply_node, self.root, image, submit, on_result, stop, transformed)
+
+    def _apply_node(self, node: TransformationNode, image, submit: Callable, on_result: Callable, stop: Callable[[], bool], transformed: dict):
+        if stop():
+            return
+        if node.transform_id is not None:
+            image = self._apply_transform(node, image, transformed)
+        if image is None:
+            for model_id in node.subtree_model_ids():
+                on_result(model_id, None)
+            return
+
+        for child in node.children.values():
+            submit(self._apply_node, child, image, submit, on_result, stop, transformed)
+        for model_id in node.model_ids:
+            on_result(model_id, image)
+
+    @staticmethod
+    def _apply_transform(node: TransformationNode, image, transformed: dict):
+        if node.prefix in transformed:
+            return transformed[node.prefix]
+        return Transformations.apply(node.transform_id, image)
@@ -1,19 +1,43 @@
 from PIL import Image
 import numpy as np
-import cv2
-import mediapipe as mp
-import tensorflow as tf
 import os
-from skimage.morphology import remove_small_holes, remove_small_objects
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from enum import Enum
+from typing import Iterable, Optional
 
 from ..config import settings
+from ..metrics import TRANSFORM_SECONDS, NO_HAND_TOTAL, record
+from ..debug_capture import capture
+from .compiled_model import CompiledModel
+from .batching import BatchingQueue
+from . import tflite_backend
 
+# Heavy dependencies (tensorflow, mediapipe, cv2) are imported where they are used,
+# so importing the application stays fast. They are imported up front during warm-up, see startup.py
+
+# Fractional bits of the hand mask polygon coordinates
+MASK_SUBPIXEL_BITS = 4
 
 class Transformation:
     def apply(self, image):
         raise NotImplementedError("Each transformation must implement the 'apply' method.")
 
+    # Prepares the transformation for the first request (e.g. traces the models it uses)
+    def warm_up(self):
+        pass
+
+    # Output of the transformation for a synthetic image, used to validate pipelines without running the models
+    def dry_run(self, image):
+        return self.apply(image)
+
+    # Size (width, height) the transformation resamples the image to, None if it keeps the resolution
+    def resampled_size(self) -> Optional[tuple[int, int]]:
+        return None
+
 # Rotates the image by the specified angle. image must be a PIL Image object
 class RotateImageIfVertical(Transformation):
     def __init__(self, angle=90, verbose=False):
@@ -26,12 +50,6 @@ class RotateImageIfVertical(Transformation):
         
         if image.height > image.width:
             image = image.rotate(90, expand=True)
-            
-        if self.verbose:
-            try:
-                image.save("tr_rotated_image.jpg")
-            except Exception as e:
-                print("Could not save rotated image:", e)
         return image
 
 # Converts the image to grayscale using the L mode. image must be a PIL Image object
@@ -43,11 +61,6 @@ class GrayscaleImage(Transformation):
         if not isinstance(image, Image.Image):
             raise ValueError("GrayscaleTransform: Image must be a PIL Image.")
         image = image.convert('L')
-        if self.verbose:
-            try:
-                image.save("tr_grayscale_image.jpg")
-            except Exception as e:
-                print("Could not save grayscale image:", e)
         return image
 
 # Resizes the image to the target size using the Lanczos resampling method. image must be a PIL Image object
@@ -56,6 +69,9 @@ class ResizeImage(Transformation):
         self.target_size = target_size
         self.verbose = verbose
 
+    def resampled_size(self):
+        return self.target_size
+
     def apply(self, image):
         if isinstance(image, np.ndarray):
             image = Image.fromarray(image)
@@ -64,11 +80,6 @@ class ResizeImage(Transformation):
             raise ValueError("ResizeTransform: Image must be a PIL Image.")
         
         image = image.resize(self.target_size, Image.Resampling.LANCZOS)
-        if self.verbose:
-            try:
-                image.save("tr_resized_image.jpg")
-            except Exception as e:
-                print("Could not save resized image:", e)
     
         return image
     
@@ -83,8 +94,7 @@ class Normalize(Transformation):
         if not isinstance(image, np.ndarray):
             raise ValueError("NormalizeTransform: Image must be a PIL Image or a numpy array.")
         
-        image = image.astype(np.float32)
-        image = image / 255.0
+        image = np.divide(image, np.float32(255.0), dtype=np.float32)
         
         if self.verbose:
             print(f"Normalized image array to range [0, 1]. Min value: {image.min()}, Max value: {image.max()}")
@@ -128,65 +138,253 @@ class AddBatchDim(Transformation):
             print("Added batch dimension to image array. New shape:", image.shape)
         return image
         
-mp_hands = mp.solutions.hands
+# Pool of MediaPipe Hands graphs. A graph can't process images from multiple threads at once,
+# so every concurrent request takes its own graph. Graphs are built on demand up to size, then requests wait for a free one
+class HandsPool:
+    def __init__(self, size: int, min_detection_confidence=0.5):
+        self.size = max(1, size)
+        self.min_detection_confidence = min_detection_confidence
+        self.created = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _create(self):
+        import mediapipe as mp
+
+        return mp.solutions.hands.Hands(static_image_mode=True, max_num_hands=1, min_detection_confidence=self.min_detection_confidence)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self._idle.get()
+        try:
+            return self._create()
+        except Exception:
+            with self._lock:
+                self.created -= 1
+            raise
+
+    def release(self, hands):
+        self._idle.put(hands)
+
+    @contextmanager
+    def hands(self):
+        hands = self.acquire()
+        try:
+            yield hands
+        finally:
+            self.release(hands)
+
+# MediaPipe Hands graph in tracking mode (static_image_mode=False) of a single live session.
+# Consecutive frames of the session reuse the hand found in the previous frame instead of running the palm detection again.
+# The graph is built on first use, a session processes one frame at a time
+class TrackingHands:
+    def __init__(self, min_detection_confidence=0.5, min_tracking_confidence=0.5):
+        self.min_detection_confidence = min_detection_confidence
+        self.min_tracking_confidence = min_tracking_confidence
+        self.hands = None
+
+    def process(self, image: np.ndarray):
+        if self.hands is None:
+            import mediapipe as mp
+
+            self.hands = mp.solutions.hands.Hands(
+                static_image_mode=False,
+                max_num_hands=1,
+                min_detection_confidence=self.min_detection_confidence,
+                min_tracking_confidence=self.min_tracking_confidence,
+            )
+        return self.hands.process(image)
+
+    def close(self):
+        if self.hands is not None:
+            self.hands.close()
+            self.hands = None
+
+# Tracking graph of the live session the current request belongs to, HandDetection uses it instead of the pool
+tracking_hands: ContextVar[Optional[TrackingHands]] = ContextVar("tracking_hands", default=None)
+
 # Detects hands in the image using the MediaPipe Hands model. 
 # Returns a mask with the detected hand filled in white, None if no hand was detected. image must be a PIL Image object
+# MediaPipe gets the image downscaled to detection_max_size, the mask is rasterized directly at output_shape
 class HandDetection(Transformation):
-    def __init__(self, min_detection_confidence=0.5, output_shape=(64, 64), verbose=False):
+    def __init__(self, min_detection_confidence=0.5, output_shape=(64, 64), pool_size=1, detection_max_size=256, verbose=False):
         self.verbose = verbose
-        self.hands = mp_hands.Hands(static_image_mode=True, max_num_hands=1, min_detection_confidence=min_detection_confidence)
+        self.min_detection_confidence = min_detection_confidence
+        # The MediaPipe graphs are built on first use
+        self.pool = HandsPool(pool_size, min_detection_confidence)
+        self.detection_max_size = detection_max_size
         self.output_shape = output_shape
 
+    def warm_up(self):
+        with self.pool.hands():
+            pass
+
+    def dry_run(self, image):
+        return Image.new('L', self.output_shape)
+
+    def _detection_frame(self, image: np.ndarray) -> np.ndarray:
+        scale = self.detection_max_size / max(image.shape[:2])
+        if not self.detection_max_size or scale >= 1:
+            return image
+        import cv2
+
+        size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
     def apply(self, image):
         if isinstance(image, Image.Image):
             image = np.array(image)
         if not isinstance(image, np.ndarray):
             raise ValueError("HandDetection: Image must be a PIL Image or a numpy array.")
         
-        results = self.hands.process(image)
+        frame = self._detection_frame(image)
+        session_hands = tracking_hands.get()
+        if session_hands is not None:
+            results = session_hands.process(frame)
+        else:
+            with self.pool.hands() as hands:
+                results = hands.process(frame)
         
         if not results.multi_hand_landmarks:
             if self.verbose:
                 print("Mediapipe: No hands detected.")
             return None
         
-        mask = np.zeros(image.shape[:2], dtype=np.uint8)
+        import cv2
+
+        # Landmarks are normalized, the polygon is drawn at the output size with anti-aliased edges and sub-pixel precision
+        width, height = self.output_shape
+        mask = np.zeros((height, width), dtype=np.uint8)
         for hand_landmarks in results.multi_hand_landmarks:
-            points = [(int(lm.x * image.shape[1]), int(lm.y * image.shape[0])) for lm in hand_landmarks.landmark]
-            cv2.fillPoly(mask, [np.array(points, dtype=np.int32)], 255)
+            points = np.array([(lm.x * width, lm.y * height) for lm in hand_landmarks.landmark])
+            points = np.round(points * (1 << MASK_SUBPIXEL_BITS)).astype(np.int32)
+            cv2.fillPoly(mask, [points], 255, lineType=cv2.LINE_AA, shift=MASK_SUBPIXEL_BITS)
             
         im = Image.fromarray(mask)
-        im = im.resize(self.output_shape, Image.Resampling.LANCZOS)
-        if im.mode != 'L':
-            im = im.convert('L')
-        
-        if self.verbose:
-            try:
-                im.save("tr_hand_mask.png")
-            except Exception as e:
-                print("Could not save hand mask:", e)
         return im
 
 # Segments the image using a U-Net model. image must be a PIL Image object or a numpy array
-# Return a binary mask with the segmented hand, None if no hand was detected
+# Return a binary mask with the segmented hand, None if no hand was detected.
+# Objects smaller than min_object_size are removed from the mask and holes smaller than max_hole_size are filled
+# (4-connectivity, like skimage remove_small_objects / remove_small_holes), masks below min_mask_area count as no hand.
+# Concurrent requests are segmented in one batch if batching is enabled
 class UnetSegmentation(Transformation):
-    def __init__(self, model_filename, img_shape=(128, 128), verbose=False):
+    def __init__(self, model_filename, img_shape=(128, 128), min_object_size=128, max_hole_size=256, min_mask_area=900, verbose=False):
         self.model_filename = model_filename
         self.img_shape = img_shape
+        self.min_object_size = min_object_size
+        self.max_hole_size = max_hole_size
+        self.min_mask_area = min_mask_area
         self.verbose = verbose
-        
-        unet_model_path = os.path.join(settings.ai_models_folder, model_filename)
-        if not os.path.exists(unet_model_path):
-            raise ValueError(f"UnetSegmentation: Model file {unet_model_path} does not exist.")
-        
-        self.unet_model = tf.keras.models.load_model(unet_model_path)
+        # The U-Net model is loaded on first use
+        self.unet_model = None
+        self.unet_predict = None
+        self.batching_queue = None
+        self._load_lock = threading.Lock()
+        # Preallocated float32 input of the U-Net, one per thread
+        self._local = threading.local()
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    # The batching thread doesn't survive fork, forked workers (see prefork.py) start their own
+    def _reset_after_fork(self):
+        if self.unet_predict is not None:
+            self.batching_queue = self._create_batching_queue(self.unet_predict)
+
+    @staticmethod
+    def _create_batching_queue(unet_predict) -> Optional[BatchingQueue]:
+        if not settings.batching_enabled:
+            return None
+        return BatchingQueue(
+            name="unet",
+            predict_fn=unet_predict,
+            max_batch_size=settings.batching_max_batch_size,
+            max_wait_ms=settings.batching_max_wait_ms,
+        )
+
+    def _ensure_loaded(self):
+        if self.unet_predict is not None:
+            return
+        with self._load_lock:
+            if self.unet_predict is not None:
+                return
+            unet_model_path = os.path.join(settings.ai_models_folder, self.model_filename)
+            if not os.path.exists(unet_model_path):
+                raise ValueError(f"UnetSegmentation: Model file {unet_model_path} does not exist.")
+            
+            import tensorflow as tf
+
+            self.unet_model = tf.keras.models.load_model(unet_model_path)
+            unet_predict = CompiledModel(self.unet_model, traced=settings.traced_inference) if settings.compiled_inference else self.unet_model.predict
+            if isinstance(unet_predict, CompiledModel):
+                unet_predict.warm_up()
+            if settings.inference_backend == "tflite":
+                unet_predict = self._load_tflite_model(unet_model_path, unet_predict) or unet_predict
+            self.batching_queue = self._create_batching_queue(unet_predict)
+            self.unet_predict = unet_predict
+
+    # Converted U-Net, None if it doesn't agree with the Keras one on the mask pixels of the calibration images
+    def _load_tflite_model(self, unet_model_path: str, reference_fn) -> Optional[tflite_backend.TFLiteModel]:
+        def calibration_samples():
+            images = tflite_backend.calibration_images(settings.tflite_calibration_samples)
+            return [
+                np.divide(np.asarray(image.resize(self.img_shape, Image.Resampling.LANCZOS)), np.float32(255.0), dtype=np.float32)[np.newaxis]
+                for image in images
+            ]
+
+        stat = os.stat(unet_model_path)
+        tflite_model = tflite_backend.load_tflite_model(
+            self.unet_model, f"{self.model_filename}:{stat.st_size}:{stat.st_mtime_ns}", reference_fn, calibration_samples,
+            decision=tflite_backend.mask_decision,
+        )
+        if tflite_model is not None:
+            tflite_model.warm_up()
+            # The Keras model is not kept, the converted one is self-contained
+            self.unet_model = None
+        return tflite_model
+
+    def warm_up(self):
+        self._ensure_loaded()
+
+    def resampled_size(self):
+        return self.img_shape
+
+    def dry_run(self, image):
+        return np.zeros(self.img_shape[::-1], dtype=np.uint8)
+
+    def _input_buffer(self) -> np.ndarray:
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = np.empty((1, self.img_shape[1], self.img_shape[0], 3), dtype=np.float32)
+        return buffer
     
-    @staticmethod   
-    def check_if_mask_almost_empty(mask):
-        count_non_zero = np.count_nonzero(mask)
-        if count_non_zero < 900:
-            return True
-        
+    # Removes the small objects and fills the small holes of the binary mask, returns the mask and its area.
+    # Holes are searched for after the small objects are removed, as removing an object can merge the background
+    def _clean_mask(self, mask: np.ndarray) -> tuple[np.ndarray, int]:
+        import cv2
+
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=4)
+        areas = stats[:, cv2.CC_STAT_AREA]
+        keep = areas >= self.min_object_size
+        # Label 0 is the background
+        keep[0] = False
+        mask = keep.astype(np.uint8)[labels]
+
+        _, hole_labels, hole_stats, _ = cv2.connectedComponentsWithStats(1 - mask, connectivity=4)
+        hole_areas = hole_stats[:, cv2.CC_STAT_AREA]
+        fill = hole_areas < self.max_hole_size
+        # Label 0 of the inverted mask are the kept objects
+        fill[0] = True
+        mask = fill.astype(np.uint8)[hole_labels]
+        return mask, int(areas[keep].sum() + hole_areas[1:][fill[1:]].sum())
+
     def apply(self, image):
         if isinstance(image, np.ndarray):
             image = Image.fromarray(image)
@@ -197,30 +395,26 @@ class UnetSegmentation(Transformation):
         
         # Preprocess image before segmentation with U-Net
         image = image.resize(self.img_shape, Image.Resampling.LANCZOS)
-        image = np.array(image)
-        image = image / 255.0
-        image = np.expand_dims(image, axis=0)
+        image = np.divide(np.asarray(image), np.float32(255.0), out=self._input_buffer()[0], casting="unsafe")[np.newaxis]
         
-        result = self.unet_model.predict(image)
+        self._ensure_loaded()
+        if self.batching_queue is not None:
+            result = self.batching_queue.predict(image)
+        else:
+            result = self.unet_predict(image)
         
         # Convert the output to a binary mask
         pred_mask = (result.squeeze() > 0.5).astype(np.uint8) 
-        mask_bool = pred_mask.astype(bool)
-        processed_mask = remove_small_objects(mask_bool, min_size=128)
-        processed_mask = remove_small_holes(processed_mask, area_threshold=256).astype(np.uint8)
+        processed_mask, area = self._clean_mask(pred_mask)
         
-        if self.check_if_mask_almost_empty(processed_mask):
+        if area < self.min_mask_area:
             if self.verbose:
                 print("UnetSegmentation: No hands detected.")
             return None
         
-        assert np.all(np.isin(processed_mask, [0, 1])), "UnetSegmentation: Mask contains values other than 0 and 1."
-        if self.verbose:
-            try:
-                im = Image.fromarray(processed_mask * 255)
-                im.save("tr_unet_mask.png")
-            except Exception as e:
-                print("Could not save U-Net mask:", e)
+        if settings.debug:
+            assert np.all(np.isin(processed_mask, [0, 1])), "UnetSegmentation: Mask contains values other than 0 and 1."
+            assert np.count_nonzero(processed_mask) == area, "UnetSegmentation: Mask area doesn't match the components."
                 
         return processed_mask
     
@@ -237,16 +431,11 @@ class ResnetPreprocess(Transformation):
         if image.shape != (224, 224, 3):
             raise ValueError("ResnetPreprocess: Image must be of shape (224, 224, 3).")
         
-        image = image.astype(np.float32)
-        image = tf.keras.applications.resnet50.preprocess_input(image)
+        # Same as tf.keras.applications.resnet50.preprocess_input (caffe mode): RGB -> BGR, then the mean is subtracted
+        image = np.subtract(image[..., ::-1], np.array([103.939, 116.779, 123.68], dtype=np.float32), dtype=np.float32)
         
         if self.verbose:
             print("Preprocessed image array for ResNet model.")
-            try:
-                im = Image.fromarray(image.astype(np.uint8))
-                im.save("tr_resnet_preprocessed_image.jpg")
-            except Exception as e:
-                print("Could not save ResNet preprocessed image:", e)
         return image
 
 class TransformationType(Enum):
@@ -275,7 +464,11 @@ class Transformations:
                 TransformationType.ROTATE: RotateImageIfVertical(angle=90, verbose=settings.debug),
                 TransformationType.RESIZE: ResizeImage(target_size=(224, 224), verbose=settings.debug),
                 TransformationType.GRAYSCALE: GrayscaleImage(verbose=settings.debug),
-                TransformationType.MP_HANDS: HandDetection(verbose=settings.debug),
+                TransformationType.MP_HANDS: HandDetection(
+                    pool_size=settings.hand_detection_pool_size or settings.inference_workers,
+                    detection_max_size=settings.hand_detection_max_size,
+                    verbose=settings.debug,
+                ),
                 TransformationType.U_NET: UnetSegmentation(model_filename=settings.unet_model_name, verbose=settings.debug),
                 TransformationType.NORMALIZE: Normalize(verbose=settings.debug),
                 TransformationType.ADD_GRAYSCALE_CHANNEL: AddGrayscaleChannel(verbose=settings.debug),
@@ -288,7 +481,55 @@ class Transformations:
     def get_transform_by_id(cls, transform_id):
         cls._initialize_transformations()
         return cls._transformations.get(transform_id)
-    
+
+    # Warms up the given transformations (all if None), loading the models they use
+    @classmethod
+    def warm_up(cls, transform_ids: Optional[Iterable[int]] = None):
+        cls._initialize_transformations()
+        if transform_ids is None:
+            transforms = cls._transformations.values()
+        else:
+            transforms = {cls.get_transform(transform_id) for transform_id in transform_ids}
+        for transform in transforms:
+            transform.warm_up()
+
+    # Resolves a transformation id (as stored in the database) to the transformation object
+    @classmethod
+    def get_transform(cls, transform_id: int) -> Transformation:
+        try:
+            transformation_type = TransformationType(transform_id)
+        except ValueError:
+            raise ValueError(f"Invalid transformation id {transform_id}")
+        transform = cls.get_transform_by_id(transformation_type)
+        if not transform:
+            raise ValueError(f"Transformation {transform_id} not found.")
+        return transform
+
+    # Applies the transformation, recording its duration and "no hand detected" (None) outcomes
+    @classmethod
+    def apply(cls, transform_id: int, image):
+        transform = cls.get_transform(transform_id)
+        name = TransformationType(transform_id).name.lower()
+        start = time.perf_counter()
+        result = transform.apply(image)
+        seconds = time.perf_counter() - start
+        TRANSFORM_SECONDS.labels(name).observe(seconds)
+        record(name, seconds)
+        capture(name, result)
+        if result is None:
+            NO_HAND_TOTAL.labels(name).inc()
+        return result
+
+    # Smallest length of the shorter image side that the chain of transformations needs, None if it needs full resolution.
+    # Only the first resampling transformation counts, the ones before it must keep the resolution (e.g. rotation)
+    @classmethod
+    def required_input_size(cls, transform_ids: Iterable[int]) -> Optional[int]:
+        for transform_id in transform_ids:
+            size = cls.get_transform(transform_id).resampled_size()
+            if size is not None:
+                return max(size)
+        return None
+
 # grayscale: 1- rotate, 2- resize, 3- grayscale, 6- normalize, 7- add_grayscale_channel, 9- add_batch_dim
 # mediapipe: 1- rotate, 2- resize, 4- mediapipe, 6- normalize, 7- add_grayscale_channel, 9- add_batch_dim
 # unet: 1- rotate, 5- unet, 7- add_grayscale_channel, 9- add_batch_dim
@@ -2,7 +2,7 @@ import jwt
 import base64
 import json
 from jwt import algorithms
-from fastapi import Header, HTTPException, Depends
+from fastapi import Header, HTTPException, Depends, Query, WebSocketException, status
 from typing import Optional
 
 from ..config import settings
@@ -14,7 +14,20 @@ def validate_token(authorization: Optional[str] = Header(default=None)):
     if authorization is None or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=403, detail="Invalid authentication credentials")
     token = authorization.split(" ")[1] 
-  
+    return _decode_token(token)
+
+# Browsers can't set headers on WebSocket connections, the token can be passed in the token query parameter instead
+def validate_websocket_token(authorization: Optional[str] = Header(default=None), token: Optional[str] = Query(default=None)):
+    if settings.skip_auth:
+        return True
+    if token is not None:
+        authorization = f"Bearer {token}"
+    try:
+        return validate_token(authorization)
+    except HTTPException as e:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+
+def _decode_token(token: str):
     options = {
         "verify_aud": False
     }
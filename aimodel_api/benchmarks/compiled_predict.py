@@ -0,0 +1,65 @@
+# Compares the per-call latency of model.predict, a direct model call and the compiled (traced tf.function) model
+# for a single sample. Run from the repository root:
+#   python -m aimodel_api.benchmarks.compiled_predict [path/to/model.keras ...] [--iterations 100]
+# Without model paths a small stand-in CNN is used
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from ..aimodel.compiled_model import CompiledModel
+
+
+def _stand_in_model() -> tf.keras.models.Model:
+    return tf.keras.Sequential([
+        tf.keras.layers.Input(shape=(128, 128, 3)),
+        tf.keras.layers.Conv2D(16, 3, activation="relu"),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Conv2D(32, 3, activation="relu"),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(3, activation="softmax"),
+    ])
+
+
+def _time_per_call(fn, inputs: np.ndarray, iterations: int) -> float:
+    fn(inputs)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(inputs)
+    return 1000 * (time.perf_counter() - start) / iterations
+
+
+def benchmark_model(name: str, keras_model: tf.keras.models.Model, iterations: int):
+    inputs = np.random.rand(1, *keras_model.input_shape[1:]).astype(np.float32)
+    compiled_model = CompiledModel(keras_model)
+
+    warm_up_start = time.perf_counter()
+    compiled_model.warm_up()
+    warm_up_ms = 1000 * (time.perf_counter() - warm_up_start)
+
+    predict_ms = _time_per_call(lambda x: keras_model.predict(x, verbose=0), inputs, iterations)
+    call_ms = _time_per_call(lambda x: keras_model(x, training=False).numpy(), inputs, iterations)
+    compiled_ms = _time_per_call(compiled_model, inputs, iterations)
+
+    print(f"{name}")
+    print(f"  warm-up (tracing)   {warm_up_ms:9.2f} ms")
+    print(f"  model.predict       {predict_ms:9.2f} ms/call")
+    print(f"  model(x)            {call_ms:9.2f} ms/call")
+    print(f"  compiled            {compiled_ms:9.2f} ms/call  ({predict_ms / compiled_ms:.1f}x faster than predict)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-call latency of model.predict vs the compiled model")
+    parser.add_argument("models", nargs="*", help="Paths to .keras model files")
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    if not args.models:
+        benchmark_model("stand-in CNN (128x128x3)", _stand_in_model(), args.iterations)
+    for path in args.models:
+        benchmark_model(path, tf.keras.models.load_model(path), args.iterations)
+
+
+if __name__ == "__main__":
+    main()
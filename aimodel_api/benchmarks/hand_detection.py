@@ -0,0 +1,54 @@
+# Measures the per-call latency and throughput of the MediaPipe hand detection against the number of concurrent callers,
+# with a single shared Hands graph (all calls serialized) and with a pool of graphs (one per caller). Run from the repository root:
+#   python -m aimodel_api.benchmarks.hand_detection [path/to/image.jpg ...] [--concurrency 1 2 4 8] [--iterations 50]
+# Without image paths a synthetic image is used, MediaPipe finds no hand in it but still runs the palm detection
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from ..aimodel.transformations import HandDetection
+
+
+def _synthetic_image() -> Image.Image:
+    return Image.fromarray((np.random.rand(224, 224, 3) * 255).astype(np.uint8))
+
+
+def _run(detection: HandDetection, images: list[Image.Image], concurrency: int, iterations: int) -> tuple[float, float]:
+    latencies = []
+
+    def call(i: int):
+        start = time.perf_counter()
+        detection.apply(images[i % len(images)])
+        latencies.append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        list(executor.map(call, range(iterations * concurrency)))
+        elapsed = time.perf_counter() - start
+    return 1000 * float(np.mean(latencies)), len(latencies) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hand detection latency against concurrency")
+    parser.add_argument("images", nargs="*", help="Paths to images with hands")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--iterations", type=int, default=50, help="Calls per concurrent caller")
+    parser.add_argument("--detection-max-size", type=int, default=256)
+    args = parser.parse_args()
+
+    images = [Image.open(path).convert("RGB") for path in args.images] or [_synthetic_image()]
+    print(f"{'concurrency':>11} {'pool':>5} {'latency':>12} {'throughput':>14}")
+    for concurrency in args.concurrency:
+        for pool_size in sorted({1, concurrency}):
+            detection = HandDetection(pool_size=pool_size, detection_max_size=args.detection_max_size)
+            # Builds the graphs before measuring
+            _run(detection, images, concurrency, 1)
+            latency_ms, throughput = _run(detection, images, concurrency, args.iterations)
+            print(f"{concurrency:>11} {pool_size:>5} {latency_ms:>9.2f} ms {throughput:>9.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+# Offline benchmark suite of the inference path, runs without the real .keras files.
+# Small stand-in Keras models are generated with the input shapes of the models in models.json (and a stand-in U-Net),
+# and synthetic hand images are drawn. Reports per-transform, per-model and predict_all latency, the memory allocated
+# per call and the throughput at different concurrency levels. Run from the repository root:
+#   python -m aimodel_api.benchmarks.suite [--iterations 50] [--concurrency 1 2 4 8] [--output results.json] [--compare baseline.json]
+# The JSON output of two commits can be compared with --compare
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from ..config import settings
+
+MODELS_JSON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "database", "initial_data", "models.json")
+
+
+def _configure(models_folder: str):
+    settings.ai_models_folder = models_folder
+    settings.unet_model_name = settings.unet_model_name or "unet_stand_in.keras"
+    settings.lazy_model_loading = False
+    # Every call must run the models
+    settings.prediction_cache_enabled = False
+
+
+def _stand_in_classifier(input_shape: tuple):
+    import tensorflow as tf
+
+    return tf.keras.Sequential([
+        tf.keras.layers.Input(shape=input_shape),
+        tf.keras.layers.Conv2D(8, 3, strides=2, activation="relu"),
+        tf.keras.layers.Conv2D(16, 3, strides=2, activation="relu"),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(3, activation="softmax"),
+    ])
+
+
+def _stand_in_unet(input_shape: tuple):
+    import tensorflow as tf
+
+    inputs = tf.keras.layers.Input(shape=input_shape)
+    x = tf.keras.layers.Conv2D(8, 3, padding="same", activation="relu")(inputs)
+    outputs = tf.keras.layers.Conv2D(1, 3, padding="same", activation="sigmoid")(x)
+    return tf.keras.Model(inputs, outputs)
+
+
+# Saves a stand-in model for every model in models.json, the input shape is the output shape of its pipeline
+def _create_stand_in_models(models_folder: str):
+    from ..aimodel.pipeline import CompiledPipeline
+    from ..aimodel.transformations import Transformations, TransformationType
+
+    with open(MODELS_JSON) as f:
+        models_data = json.load(f)
+    unet = Transformations.get_transform(TransformationType.U_NET.value)
+    _stand_in_unet((*unet.img_shape[::-1], 3)).save(os.path.join(models_folder, settings.unet_model_name))
+    for model_data in models_data:
+        input_shape = CompiledPipeline(model_data["transformations"]).output_shape[1:]
+        _stand_in_classifier(input_shape).save(os.path.join(models_folder, model_data["path_to_model"]))
+
+
+def _register_models():
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from ..database.connection import Base
+    from ..database.populate_models import add_models_and_statistics
+    from ..aimodel.aimodels import ModelManager
+
+    # In-memory database, the benchmark doesn't touch aimodels.db
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        add_models_and_statistics(db, MODELS_JSON)
+        ModelManager().load_models_from_db(db)
+    finally:
+        db.close()
+
+
+# Skin-coloured palm with fingers on a noisy background, the upper fingers form a different gesture in every image
+def synthetic_hand_images(count: int = 8, size: tuple[int, int] = (640, 480), seed: int = 0) -> list[Image.Image]:
+    rng = np.random.default_rng(seed)
+    images = []
+    for i in range(count):
+        background = (rng.random((size[1], size[0], 3)) * 80 + 60).astype(np.uint8)
+        image = Image.fromarray(background)
+        draw = ImageDraw.Draw(image)
+        skin = tuple(int(c) for c in rng.integers([170, 110, 90], [230, 160, 130]))
+        cx, cy = size[0] // 2 + int(rng.integers(-60, 60)), size[1] // 2 + int(rng.integers(0, 60))
+        draw.ellipse([cx - 80, cy - 70, cx + 80, cy + 90], fill=skin)
+        for finger in range(5):
+            if (i >> finger) & 1:
+                x = cx - 70 + finger * 35
+                draw.rounded_rectangle([x, cy - 200, x + 26, cy - 40], radius=12, fill=skin)
+        images.append(image)
+    return images
+
+
+def _latency(fn, inputs: list, iterations: int) -> dict:
+    fn(inputs[0])
+    times = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(inputs[i % len(inputs)])
+        times.append(1000 * (time.perf_counter() - start))
+    return {
+        "mean_ms": round(float(np.mean(times)), 4),
+        "p50_ms": round(float(np.percentile(times, 50)), 4),
+        "p95_ms": round(float(np.percentile(times, 95)), 4),
+    }
+
+
+# Bytes allocated by Python and NumPy during a single call (peak and still allocated after it)
+def _allocations(fn, inputs: list, iterations: int) -> dict:
+    fn(inputs[0])
+    peaks, retained = [], []
+    for i in range(min(iterations, 10)):
+        tracemalloc.start()
+        fn(inputs[i % len(inputs)])
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+        retained.append(current)
+    return {"peak_kb": round(float(np.mean(peaks)) / 1024, 1), "retained_kb": round(float(np.mean(retained)) / 1024, 1)}
+
+
+def _throughput(fn, inputs: list, concurrency: int, iterations: int) -> float:
+    calls = iterations * concurrency
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda i: fn(inputs[i % len(inputs)]), range(concurrency)))
+        start = time.perf_counter()
+        list(executor.map(lambda i: fn(inputs[i % len(inputs)]), range(calls)))
+        elapsed = time.perf_counter() - start
+    return round(calls / elapsed, 2)
+
+
+def benchmark_transforms(images: list[Image.Image], iterations: int) -> dict:
+    from ..aimodel.aimodels import ModelManager
+    from ..aimodel.transformations import Transformations
+
+    results = {}
+    for model_id, model_data in ModelManager().registered_models.items():
+        pipeline = model_data.pipeline
+        # Inputs of every step are recorded first, every step is then timed on its own inputs
+        step_inputs = {transform_id: [] for transform_id in pipeline.image_transform_ids}
+        tensor_inputs = []
+        for image in images:
+            for transform_id, transform in zip(pipeline.image_transform_ids, pipeline.image_transforms):
+                step_inputs[transform_id].append(image)
+                image = transform.apply(image)
+                if image is None:
+                    break
+            else:
+                tensor_inputs.append(image)
+        for transform_id, inputs in step_inputs.items():
+            name = f"{transform_id}:{type(Transformations.get_transform(transform_id)).__name__}"
+            if inputs and name not in results:
+                results[name] = _latency(Transformations.get_transform(transform_id).apply, inputs, iterations)
+        if tensor_inputs and pipeline.tensor_preparation is not None:
+            name = f"fused:{'-'.join(map(str, pipeline.tensor_transform_ids))}"
+            results[name] = _latency(pipeline.finish, tensor_inputs, iterations)
+    return results
+
+
+def run(iterations: int, concurrency: list[int]) -> dict:
+    from ..aimodel.aimodels import ModelManager
+
+    images = synthetic_hand_images()
+    with tempfile.TemporaryDirectory() as models_folder:
+        _configure(models_folder)
+        _create_stand_in_models(models_folder)
+        _register_models()
+        model_manager = ModelManager()
+
+        results = {
+            "transforms": benchmark_transforms(images, iterations),
+            "models": {},
+            "predict_all": {},
+            "throughput": {},
+        }
+        for model_id in model_manager.registered_models:
+            predict = lambda image, model_id=model_id: model_manager.predict(model_id, image)
+            results["models"][str(model_id)] = {
+                **_latency(predict, images, iterations),
+                **_allocations(predict, images, iterations),
+            }
+        results["predict_all"] = {
+            **_latency(model_manager.predict_all, images, iterations),
+            **_allocations(model_manager.predict_all, images, iterations),
+        }
+        for level in concurrency:
+            results["throughput"][str(level)] = {
+                "predict_all_rps": _throughput(model_manager.predict_all, images, level, iterations),
+                "model_rps": {
+                    str(model_id): _throughput(lambda image, model_id=model_id: model_manager.predict(model_id, image), images, level, iterations)
+                    for model_id in model_manager.registered_models
+                },
+            }
+    return results
+
+
+def _metadata(iterations: int) -> dict:
+    import tensorflow as tf
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "tensorflow": tf.__version__,
+        "cpu_count": os.cpu_count(),
+        "iterations": iterations,
+    }
+
+
+# Ratios of the mean latencies against a previous run (below 1 is faster)
+def compare(results: dict, baseline: dict) -> dict:
+    ratios = {}
+    for section in ("transforms", "models"):
+        for name, stats in results[section].items():
+            previous = baseline.get(section, {}).get(name)
+            if previous:
+                ratios[f"{section}/{name}"] = round(stats["mean_ms"] / previous["mean_ms"], 3)
+    if baseline.get("predict_all"):
+        ratios["predict_all"] = round(results["predict_all"]["mean_ms"] / baseline["predict_all"]["mean_ms"], 3)
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark suite of the transformations, models and the ensemble")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--output", help="Path of the JSON results, printed to stdout if not given")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    args = parser.parse_args()
+
+    output = {"metadata": _metadata(args.iterations), "results": run(args.iterations, args.concurrency)}
+    if args.compare:
+        with open(args.compare) as f:
+            output["comparison"] = compare(output["results"], json.load(f)["results"])
+
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+        print(f"Results written to {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# Sweep of the CPU thread topology settings: TF intra-op/inter-op threads, OpenCV threads, inference workers and
+# the CPU affinity. Every combination runs in its own process (the TF pools can't be resized once the runtime started)
+# on the stand-in models of the benchmark suite. Concurrent clients send JPEG images through the inference executor
+# like the predictions endpoint does, the throughput and the latency percentiles are reported. Run from the repository root:
+#   python -m aimodel_api.benchmarks.thread_topology [--intra 1 0] [--inter 1 0] [--opencv 1 -1] [--workers 2 4]
+#       [--affinity all 0-3] [--clients 8] [--requests 200] [--model-id -1] [--output results.json]
+# 0 TF threads and -1 OpenCV threads are the library defaults, "all" is no CPU affinity
+import argparse
+import io
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from ..config import settings
+from .suite import _create_stand_in_models, _configure, _metadata, _register_models, synthetic_hand_images
+
+
+# "0-3,6" -> [0, 1, 2, 3, 6], "all" -> []
+def parse_cpus(spec: str) -> list[int]:
+    if spec == "all":
+        return []
+    cpus = []
+    for part in spec.split(","):
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _jpeg_images() -> list[bytes]:
+    images = []
+    for image in synthetic_hand_images():
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG")
+        images.append(buffer.getvalue())
+    return images
+
+
+# Runs in the child process: applies the topology, loads the stand-in models and sends the requests
+def run_topology(topology: dict, models_folder: str, model_id: int, clients: int, requests: int) -> dict:
+    from ..aimodel.executor import InferenceExecutor
+    from ..routers.predictions import _predict
+    from ..startup import apply_thread_topology
+
+    settings.tf_intra_op_threads = topology["intra"]
+    settings.tf_inter_op_threads = topology["inter"]
+    settings.opencv_threads = topology["opencv"]
+    settings.inference_workers = topology["workers"]
+    settings.cpu_affinity = parse_cpus(topology["affinity"])
+    settings.inference_queue_size = clients
+    # The synthetic hands aren't always detected, the gate would answer them without running the models
+    settings.hand_gate_transform_ids = []
+    apply_thread_topology()
+
+    _configure(models_folder)
+    _register_models()
+    executor = InferenceExecutor()
+    executor.start()
+    images = _jpeg_images()
+    # Warm-up, the first calls trace the models and build the MediaPipe graphs
+    for future in [executor.submit(_predict, model_id, images[i % len(images)]) for i in range(topology["workers"])]:
+        future.result()
+
+    latencies = []
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def client():
+        while (i := next(counter)) < requests:
+            start = time.perf_counter()
+            executor.submit(_predict, model_id, images[i % len(images)]).result()
+            with lock:
+                latencies.append(1000 * (time.perf_counter() - start))
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+    return {
+        "throughput_rps": round(requests / elapsed, 2),
+        "mean_ms": round(float(np.mean(latencies)), 2),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+    }
+
+
+def _run_child(topology: dict, models_folder: str, args) -> dict:
+    command = [
+        sys.executable, "-m", __spec__.name, "--child", json.dumps(topology),
+        "--models-folder", models_folder, "--model-id", str(args.model_id),
+        "--clients", str(args.clients), "--requests", str(args.requests),
+    ]
+    env = {**os.environ, "TF_CPP_MIN_LOG_LEVEL": "3"}
+    process = subprocess.run(command, capture_output=True, text=True, env=env)
+    # The result is the last line of the output, the rest is the logging of the application
+    lines = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not lines:
+        return {"error": (process.stderr.strip().splitlines() or ["no output"])[-1]}
+    return json.loads(lines[-1])
+
+
+def sweep(args) -> list[dict]:
+    topologies = [
+        {"intra": intra, "inter": inter, "opencv": opencv, "workers": workers, "affinity": affinity}
+        for intra, inter, opencv, workers, affinity in itertools.product(args.intra, args.inter, args.opencv, args.workers, args.affinity)
+    ]
+    results = []
+    with tempfile.TemporaryDirectory() as models_folder:
+        _configure(models_folder)
+        _create_stand_in_models(models_folder)
+        for n, topology in enumerate(topologies, 1):
+            result = {**topology, **_run_child(topology, models_folder, args)}
+            print(f"[{n}/{len(topologies)}] {_row(result)}", file=sys.stderr)
+            results.append(result)
+    return results
+
+
+def _row(result: dict) -> str:
+    topology = f"intra={result['intra']:<3} inter={result['inter']:<3} opencv={result['opencv']:<3} workers={result['workers']:<3} cpus={result['affinity']:<8}"
+    if "error" in result:
+        return f"{topology} error: {result['error']}"
+    return (f"{topology} {result['throughput_rps']:8.2f} req/s  p50 {result['p50_ms']:8.2f} ms  "
+            f"p95 {result['p95_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency of the CPU thread topology settings")
+    parser.add_argument("--intra", type=int, nargs="+", default=[1, 0], help="TF intra-op threads (0 - TF default)")
+    parser.add_argument("--inter", type=int, nargs="+", default=[1, 0], help="TF inter-op threads (0 - TF default)")
+    parser.add_argument("--opencv", type=int, nargs="+", default=[1, -1], help="OpenCV threads (-1 - OpenCV default)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4], help="Inference workers")
+    parser.add_argument("--affinity", nargs="+", default=["all"], help="CPU sets, e.g. 0-3 or 0,2,4 (all - no affinity)")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per topology")
+    parser.add_argument("--model-id", type=int, default=-1, help="Model of the requests (-1 - ensemble)")
+    parser.add_argument("--output", help="Path of the JSON results")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--models-folder", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_topology(json.loads(args.child), args.models_folder, args.model_id, args.clients, args.requests)
+        print(json.dumps(result))
+        return
+
+    results = sweep(args)
+    ranked = sorted(results, key=lambda result: -result.get("throughput_rps", 0))
+    print("Topologies by throughput:")
+    for result in ranked:
+        print(f"  {_row(result)}")
+    if args.output:
+        metadata = {**_metadata(args.requests), "clients": args.clients, "model_id": args.model_id}
+        with open(args.output, "w") as f:
+            json.dump({"metadata": metadata, "results": results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
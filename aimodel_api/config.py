@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -12,6 +14,129 @@ class Settings(BaseSettings):
     
     skip_auth: bool = False
 
+    # With debug on, the intermediate images and tensors of debug_capture_rate of the requests are captured in memory
+    # (the last debug_capture_buffer_size requests) and written to debug_capture_folder in the background, see /debug/captures
+    debug_capture_rate: float = 0.1
+    debug_capture_buffer_size: int = 64
+    debug_capture_folder: str = "debug_captures"
+
+    # Run models through a traced tf.function instead of model.predict
+    compiled_inference: bool = True
+    # Trace the models into tf.function graphs, disabled in the pre-fork mode
+    traced_inference: bool = True
+
+    # Inference backend of the models and the U-Net: "keras" or "tflite". With "tflite" the .keras files are converted
+    # ("none", "dynamic" - int8 weights, "int8" - int8 weights and activations calibrated on the calibration images) during
+    # the warm-up and cached in tflite_cache_folder (default: <ai_models_folder>/tflite_cache). The calibration images
+    # (tflite_calibration_folder, real photos of the gestures) run through the pipeline of each model, a model is only
+    # converted if at least tflite_min_calibration_samples of them pass it and its predictions agree with the Keras model
+    # on at least tflite_min_agreement of them. Otherwise the model is served by Keras
+    inference_backend: Literal["keras", "tflite"] = "keras"
+    tflite_quantization: Literal["none", "dynamic", "int8"] = "dynamic"
+    tflite_cache_folder: str = ""
+    tflite_calibration_folder: str = ""
+    tflite_calibration_samples: int = 32
+    tflite_min_calibration_samples: int = 8
+    tflite_min_agreement: float = 0.98
+    tflite_threads: int = 1
+
+    # Trailing tensor transformations (normalize, channel, batch dim, ...) run as one fused step into a reused buffer
+    fused_pipelines: bool = True
+
+    # MediaPipe Hands graphs, one per concurrent request (0 - as many as inference workers).
+    # Frames are downscaled to hand_detection_max_size (longer side, 0 - no downscaling) before detection
+    hand_detection_pool_size: int = 0
+    hand_detection_max_size: int = 256
+
+    # All models are loaded at startup. With lazy_model_loading only the pinned models are, the others are loaded on first use.
+    # Above the memory budget (0 - no limit) the least recently used models that aren't pinned are evicted.
+    # The transformations of all models are warmed up at startup either way
+    lazy_model_loading: bool = False
+    models_memory_budget_mb: float = 0
+    pinned_model_ids: list[int] = []
+    models_loading_workers: int = 4
+
+    # Number of worker processes in the pre-fork serving mode (prefork.py)
+    prefork_workers: int = 2
+
+    # Models are loaded and warmed up in the background, /health/ready reports when it's done
+    background_warm_up: bool = True
+
+    # Inference executor, jobs above workers + queue size are rejected with 503
+    inference_workers: int = 4
+    inference_queue_size: int = 32
+    inference_retry_after_s: int = 1
+
+    # CPU thread topology, applied at startup before the models load (see benchmarks/thread_topology.py to tune it).
+    # TF intra-op/inter-op pools (0 - TF default, one thread per core), the OpenCV pool (-1 - OpenCV default,
+    # 0 or 1 - no threading) and the CPUs the process runs on (empty - all). MediaPipe graphs have no thread setting,
+    # their number follows hand_detection_pool_size and they run on the CPUs of cpu_affinity
+    tf_intra_op_threads: int = 0
+    tf_inter_op_threads: int = 0
+    opencv_threads: int = -1
+    cpu_affinity: list[int] = []
+
+    # Deadlines: a request carries its time budget in the X-Request-Deadline-Ms header, otherwise the default of the endpoint
+    # applies (0 - no deadline). Inference jobs run earliest deadline first, requests that expire before preprocessing
+    # or the forward pass fail with 504
+    prediction_deadline_ms: float = 5000
+    batch_deadline_ms: float = 0
+    live_frame_deadline_ms: float = 1000
+
+    # Hand-presence gate: the hand detection transformations (ids, checked in order) run once per request before the models.
+    # If none finds a hand, the response is prediction=None with the reason, without running the models.
+    # Their outputs are reused by the pipelines of the models. A request for a single model only runs the checks of the
+    # transformations its own chain uses. Empty list - no gate
+    hand_gate_transform_ids: list[int] = [4, 5]
+
+    # Ensemble (model_id=-1): models run concurrently, early exit stops once the majority can't change
+    ensemble_parallel: bool = True
+    ensemble_early_exit: bool = True
+    ensemble_workers: int = 5
+
+    # Ensemble mode of model_id=-1: "vote" - every model votes with the same weight, "cascade" - the models run one at a time,
+    # the cheapest and most accurate first, until the weighted lead of one gesture (softmax margin x historical accuracy)
+    # reaches cascade_confidence_threshold. Accuracy comes from the model statistics, smoothed towards the prior accuracy
+    # with the weight of cascade_prior_weight predictions. Cost is the moving average of the transformation and forward pass
+    # latencies, cascade_default_cost_ms until a step was measured
+    ensemble_mode: Literal["vote", "cascade"] = "vote"
+    cascade_confidence_threshold: float = 0.8
+    cascade_prior_accuracy: float = 0.7
+    cascade_prior_weight: float = 20.0
+    cascade_default_cost_ms: float = 20.0
+
+    # Cache of prediction results for byte-identical uploads
+    prediction_cache_enabled: bool = True
+    prediction_cache_max_entries: int = 1024
+    prediction_cache_ttl_s: float = 300.0
+
+    # Uploads are decoded at the smallest resolution the requested models need (JPEGs at a reduced DCT scale).
+    # Larger uploads are rejected with 413
+    reduced_decoding: bool = True
+    max_upload_bytes: int = 20 * 1024 * 1024
+    max_image_pixels: int = 50_000_000
+
+    # SQLite connection pool, writers wait up to the busy timeout for the database lock
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_busy_timeout_ms: int = 5000
+
+    # Model statistics feedback is aggregated in memory and written to the database every interval
+    statistics_flush_interval_s: float = 5.0
+
+    # Batch predictions (POST /predictions/batch): images in flight at once and images per request
+    batch_prediction_window: int = 16
+    batch_max_items: int = 10000
+
+    # Live WebSocket sessions (/predictions/live) per worker process
+    live_max_sessions: int = 4
+    live_min_tracking_confidence: float = 0.5
+
+    # Micro-batching of concurrent requests to the same model
+    batching_enabled: bool = True
+    batching_max_batch_size: int = 16
+    batching_max_wait_ms: float = 5.0
+
     model_config = SettingsConfigDict(env_file=".env")
     
 settings = Settings()
\ No newline at end of file
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import threading
+from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .connection import SessionLocal
+from .models import Model
+from ..models import AiModelDto
+
+
+# Serialized model list with its ETag
+class CatalogueSnapshot:
+    def __init__(self, models: list[AiModelDto]):
+        self.models = models
+        self.body = json.dumps([model.model_dump() for model in models], separators=(",", ":")).encode()
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+
+    # Whether the If-None-Match header matches the snapshot
+    def matches(self, if_none_match: str) -> bool:
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(tag.removeprefix("W/") == self.etag for tag in tags)
+
+
+# In-memory snapshot of the model catalogue served by GET /models.
+# The catalogue only changes when the models are registered, ModelManager.register_models_from_db rebuilds the snapshot with refresh()
+class ModelCatalogue:
+    _instance = None
+
+    # Singleton
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(ModelCatalogue, cls).__new__(cls, *args, **kwargs)
+            cls._instance._lock = threading.Lock()
+            cls._instance._snapshot = None
+        return cls._instance
+
+    def refresh(self, db: Session) -> CatalogueSnapshot:
+        models = db.scalars(select(Model).order_by(Model.id)).all()
+        snapshot = CatalogueSnapshot([AiModelDto.model_validate(model) for model in models])
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
+
+    # Snapshot of the last refresh, None if the models were not registered yet
+    @property
+    def current(self) -> Optional[CatalogueSnapshot]:
+        return self._snapshot
+
+    # Queries the database if the snapshot wasn't built yet, blocking
+    def snapshot(self) -> CatalogueSnapshot:
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        db = SessionLocal()
+        try:
+            return self.refresh(db)
+        finally:
+            db.close()
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from fastapi import Depends
@@ -9,7 +9,25 @@ from ..config import settings
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./aimodels.db"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=settings.debug)
+# Connections are shared by the threadpool, the inference executor and the statistics flush thread
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    echo=settings.debug,
+    connect_args={"check_same_thread": False},
+    pool_size=settings.database_pool_size,
+    max_overflow=settings.database_max_overflow,
+)
+
+# WAL lets readers run while a write is in progress, with synchronous=NORMAL a commit doesn't wait for fsync
+# (a commit can be lost on power failure, the database can't be corrupted). Writers wait for the lock instead of failing
+@event.listens_for(engine, "connect")
+def _configure_sqlite(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(settings.database_busy_timeout_ms)}")
+    cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
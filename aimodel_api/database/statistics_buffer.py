@@ -0,0 +1,135 @@
+import threading
+from typing import Dict
+from sqlalchemy import select, update
+
+from ..config import settings
+from .connection import SessionLocal
+from .models import ModelStatistics
+
+
+# Write-behind buffer of the model statistics. Feedback is aggregated in memory and flushed periodically
+# as one atomic UPDATE ... SET total_predictions = total_predictions + n per model, in a single transaction.
+# Increments are never lost to concurrent read-modify-write, also between several worker processes
+class StatisticsBuffer:
+    _instance = None
+
+    # Singleton
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(StatisticsBuffer, cls).__new__(cls, *args, **kwargs)
+            cls._instance._lock = threading.Lock()
+            # model_id -> [total predictions, wrong predictions]
+            cls._instance._pending = {}
+            # model_id -> (total predictions, wrong predictions) in the database as of the last flush
+            cls._instance._totals = {}
+            cls._instance._totals_loaded = False
+            cls._instance._stop = threading.Event()
+            cls._instance._thread = None
+            cls._instance.flushes = 0
+        return cls._instance
+
+    def add(self, model_id: int, wrong_prediction: bool):
+        with self._lock:
+            counts = self._pending.setdefault(model_id, [0, 0])
+            counts[0] += 1
+            if wrong_prediction:
+                counts[1] += 1
+
+    def pending(self) -> Dict[int, tuple[int, int]]:
+        with self._lock:
+            return {model_id: tuple(counts) for model_id, counts in self._pending.items()}
+
+    # Statistics of every model: the database totals as of the last flush plus the pending feedback.
+    # Includes the feedback other worker processes had flushed by then
+    def totals(self) -> Dict[int, tuple[int, int]]:
+        with self._lock:
+            totals = dict(self._totals)
+            for model_id, (total, wrong) in self._pending.items():
+                db_total, db_wrong = totals.get(model_id, (0, 0))
+                totals[model_id] = (db_total + total, db_wrong + wrong)
+        return totals
+
+    # Writes the pending counters to the database and reads back the totals, if the write fails the counters are kept
+    # for the next flush. If only the read fails the totals are read again by the next flush.
+    # Without pending counters the database is not touched, except for the first read of the totals
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending and self._totals_loaded:
+            return
+        db = SessionLocal()
+        try:
+            if pending and not self._write(db, pending):
+                return
+            try:
+                totals = {
+                    model_id: (total, wrong)
+                    for model_id, total, wrong in db.execute(
+                        select(ModelStatistics.model_id, ModelStatistics.total_predictions, ModelStatistics.wrong_predictions)
+                    )
+                }
+            except Exception as e:
+                # The written counters are no longer pending, they are added to the stale totals until the next read
+                with self._lock:
+                    for model_id, (total, wrong) in pending.items():
+                        db_total, db_wrong = self._totals.get(model_id, (0, 0))
+                        self._totals[model_id] = (db_total + total, db_wrong + wrong)
+                    self._totals_loaded = False
+                print(f"Could not read model statistics: {e}")
+                return
+            with self._lock:
+                self._totals = totals
+                self._totals_loaded = True
+        finally:
+            db.close()
+
+    # Returns whether the counters were committed, the counters are restored if not
+    def _write(self, db, pending: Dict[int, list[int]]) -> bool:
+        try:
+            for model_id, (total, wrong) in pending.items():
+                db.execute(
+                    update(ModelStatistics)
+                    .where(ModelStatistics.model_id == model_id)
+                    .values(
+                        total_predictions=ModelStatistics.total_predictions + total,
+                        wrong_predictions=ModelStatistics.wrong_predictions + wrong,
+                    )
+                )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            self._restore(pending)
+            print(f"Could not flush model statistics: {e}")
+            return False
+        self.flushes += 1
+        return True
+
+    def _restore(self, pending: Dict[int, list[int]]):
+        with self._lock:
+            for model_id, (total, wrong) in pending.items():
+                counts = self._pending.setdefault(model_id, [0, 0])
+                counts[0] += total
+                counts[1] += wrong
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="statistics-flush", daemon=True)
+            self._thread.start()
+
+    # Stops the flushing thread and writes the remaining counters
+    def shutdown(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        self.flush()
+
+    # The totals are read right away, then the counters are flushed every interval
+    def _run(self):
+        self.flush()
+        while not self._stop.wait(settings.statistics_flush_interval_s):
+            self.flush()
@@ -0,0 +1,225 @@
+import io
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from .config import settings
+
+
+# Intermediate images and tensors of a single sampled request, copied when they are produced
+class RequestCapture:
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.captured_at = time.time()
+        self.artifacts: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.written = False
+        self._lock = threading.Lock()
+
+    def add(self, name: str, value):
+        # Copied, the transformations reuse their buffers (e.g. the fused tensor preparation)
+        array = np.array(value)
+        with self._lock:
+            # Steps that run several times (e.g. a model input in a batch request) get a numbered name
+            key, n = name, 1
+            while key in self.artifacts:
+                n += 1
+                key = f"{name}_{n}"
+            self.artifacts[key] = array
+
+    def items(self) -> list[tuple[str, np.ndarray]]:
+        with self._lock:
+            return list(self.artifacts.items())
+
+    def summary(self) -> dict:
+        return {
+            "request_id": self.request_id,
+            "captured_at": self.captured_at,
+            "written": self.written,
+            "artifacts": [
+                {"name": name, "shape": list(array.shape), "dtype": str(array.dtype)}
+                for name, array in self.items()
+            ],
+        }
+
+
+# Capture of the request being handled, None if the request was not sampled.
+# Jobs on the inference executor and the ensemble run with a copy of the context, so they add to the same capture
+request_capture: ContextVar[Optional[RequestCapture]] = ContextVar("request_capture", default=None)
+
+
+# Adds the value to the capture of the current request, does nothing if the request is not sampled
+def capture(name: str, value):
+    current = request_capture.get()
+    if current is not None and value is not None:
+        current.add(name, value)
+
+
+# Image preview of an artifact: 2D arrays are grayscale, 3D arrays with 1 or 3 channels are grayscale or RGB.
+# Values outside 0-255 (normalized or mean-subtracted tensors, masks) are scaled to the full range
+def render_png(array: np.ndarray) -> Optional[bytes]:
+    array = np.squeeze(array)
+    if array.ndim == 3 and array.shape[-1] == 1:
+        array = array[..., 0]
+    if array.ndim not in (2, 3) or (array.ndim == 3 and array.shape[-1] != 3):
+        return None
+    if array.dtype != np.uint8:
+        array = array.astype(np.float32)
+        low, high = float(array.min()), float(array.max())
+        array = ((array - low) * (255.0 / (high - low)) if high > low else np.zeros_like(array)).astype(np.uint8)
+    elif array.max() <= 1:
+        # Binary masks
+        array = array * 255
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# Sampled capture of the intermediate artifacts of requests, replaces writing them to the working directory in the hot path.
+# Only a fraction of the requests is captured (debug_capture_rate, when debug is on). The captures of the last
+# debug_capture_buffer_size requests are kept in memory, a background thread writes them to
+# debug_capture_folder/<request id>/ (.npy tensors, .png previews and capture.json). If the writer falls behind,
+# captures that no longer fit the buffer are not written
+class DebugCapture:
+    _instance = None
+
+    # Singleton
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(DebugCapture, cls).__new__(cls, *args, **kwargs)
+            cls._instance._lock = threading.Lock()
+            cls._instance._captures = OrderedDict()
+            cls._instance._queue = queue.Queue()
+            cls._instance._thread = None
+            cls._instance.captured = 0
+            cls._instance.written = 0
+            cls._instance.dropped = 0
+        return cls._instance
+
+    def enabled(self) -> bool:
+        return settings.debug and settings.debug_capture_rate > 0
+
+    # Starts the capture of the request if it's sampled, the capture is set in the context of the request
+    def begin(self, current_id: str) -> Optional[RequestCapture]:
+        if not self.enabled() or random.random() >= settings.debug_capture_rate:
+            return None
+        # The id is a folder name, clients can send their own X-Request-ID
+        current = RequestCapture(re.sub(r"[^A-Za-z0-9_-]", "_", current_id)[:128])
+        request_capture.set(current)
+        return current
+
+    # Keeps the capture in the ring buffer and queues it for writing
+    def finish(self, current: RequestCapture):
+        with self._lock:
+            self._captures[current.request_id] = current
+            self._captures.move_to_end(current.request_id)
+            while len(self._captures) > settings.debug_capture_buffer_size:
+                _, evicted = self._captures.popitem(last=False)
+                if not evicted.written:
+                    self.dropped += 1
+            self.captured += 1
+        self._queue.put(current.request_id)
+
+    def get(self, current_id: str) -> Optional[RequestCapture]:
+        with self._lock:
+            return self._captures.get(current_id)
+
+    def summaries(self) -> list[dict]:
+        with self._lock:
+            captures = list(self._captures.values())
+        return [current.summary() for current in reversed(captures)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled(),
+                "rate": settings.debug_capture_rate,
+                "buffered": len(self._captures),
+                "captured": self.captured,
+                "written": self.written,
+                "dropped": self.dropped,
+            }
+
+    # Path of a file written for the request, None if it's not on the disk
+    @staticmethod
+    def _written_path(current_id: str, filename: str) -> Optional[str]:
+        root = os.path.realpath(settings.debug_capture_folder)
+        path = os.path.realpath(os.path.join(root, current_id, filename))
+        # Ids and names come from the URL, the path must stay inside a request folder of the capture folder
+        if os.path.dirname(os.path.dirname(path)) != root or not os.path.isfile(path):
+            return None
+        return path
+
+    # Summary of a capture that left the buffer, read from its capture.json. None if it was never written
+    @classmethod
+    def written_summary(cls, current_id: str) -> Optional[dict]:
+        path = cls._written_path(current_id, "capture.json")
+        if path is None:
+            return None
+        with open(path) as f:
+            return {**json.load(f), "written": True}
+
+    # Path of the PNG preview written for the artifact. None if the capture or the artifact is not on the disk,
+    # raises LookupError if the artifact was written without a preview (it can't be shown as an image)
+    @classmethod
+    def written_preview(cls, current_id: str, name: str) -> Optional[str]:
+        summary = cls.written_summary(current_id)
+        names = [artifact["name"] for artifact in summary["artifacts"]] if summary is not None else []
+        if name not in names:
+            return None
+        path = cls._written_path(current_id, f"{names.index(name):02d}_{name}.png")
+        if path is None:
+            raise LookupError(name)
+        return path
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or not self.enabled():
+                return
+            self._thread = threading.Thread(target=self._run, name="debug-capture", daemon=True)
+            self._thread.start()
+
+    # Writes the queued captures and stops the writer thread
+    def shutdown(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        while (current_id := self._queue.get()) is not None:
+            # Captures evicted from the buffer before their turn are skipped, the writer can't hold up the requests
+            current = self.get(current_id)
+            if current is None or current.written:
+                continue
+            try:
+                self._write(current)
+                current.written = True
+                with self._lock:
+                    self.written += 1
+            except Exception as e:
+                print(f"Could not write the debug capture of request {current.request_id}: {e}")
+
+    @staticmethod
+    def _write(current: RequestCapture):
+        folder = os.path.join(settings.debug_capture_folder, current.request_id)
+        os.makedirs(folder, exist_ok=True)
+        for index, (name, array) in enumerate(current.items()):
+            prefix = os.path.join(folder, f"{index:02d}_{name}")
+            np.save(f"{prefix}.npy", array, allow_pickle=False)
+            png = render_png(array)
+            if png is not None:
+                with open(f"{prefix}.png", "wb") as f:
+                    f.write(png)
+        with open(os.path.join(folder, "capture.json"), "w") as f:
+            json.dump({key: value for key, value in current.summary().items() if key != "written"}, f, indent=2)
@@ -1,12 +1,24 @@
+import time
+_import_start = time.perf_counter()
+
 from fastapi import FastAPI, Request, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 import logging
+import threading
+import uuid
 
-from .routers import predictions, models
+from .routers import predictions, live, models, health, metrics, debug
 from .config import settings
 from .database.connection import SessionLocal, create_tables, populate_database_if_empty, get_db
 from .aimodel.aimodels import ModelManager
+from .aimodel.executor import InferenceExecutor
+from .database.statistics_buffer import StatisticsBuffer
+from .startup import StartupState, timed_phase, import_heavy_modules, apply_thread_topology
+from .metrics import RequestTimings, request_id, request_timings
+from .debug_capture import DebugCapture
+
+StartupState().record_phase("import app", time.perf_counter() - _import_start)
 
 app = FastAPI(
     title=settings.app_name,
@@ -21,20 +33,87 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Every response carries the request id (X-Request-ID, taken from the request if the client sent one)
+# and a Server-Timing header with the durations of the request stages. Streamed responses (no Content-Length, e.g. the batch
+# predictions) have no Server-Timing, their stages run after the headers are sent. Sampled requests are captured, see DebugCapture
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    start = time.perf_counter()
+    current_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    timings = RequestTimings()
+    request_id.set(current_id)
+    request_timings.set(timings)
+    current_capture = DebugCapture().begin(current_id) if request.url.path.startswith(api_router.prefix + predictions.router.prefix) else None
+    response = await call_next(request)
+    if current_capture is not None:
+        response.body_iterator = _finish_capture(response.body_iterator, current_capture)
+    response.headers["X-Request-ID"] = current_id
+    if "content-length" in response.headers:
+        response.headers["Server-Timing"] = timings.server_timing(time.perf_counter() - start)
+    return response
+
+# The capture is complete once the body is sent, streamed responses (the batch predictions) run their stages while sending it
+async def _finish_capture(body_iterator, current_capture):
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        # Requests answered without running the transformations (e.g. from the prediction cache) have nothing to keep
+        if current_capture.items():
+            DebugCapture().finish(current_capture)
+
 @app.on_event("startup")
 def startup():
+    with timed_phase("thread topology"):
+        apply_thread_topology()
     db: Session = next(get_db())
     try:
-        create_tables()
-        populate_database_if_empty(db)
-        mm = ModelManager()
-        mm.load_models_from_db(db)
+        with timed_phase("database"):
+            create_tables()
+            populate_database_if_empty(db)
+            mm = ModelManager()
+            # Models are already registered in workers forked by prefork.py
+            if not mm.registered_models:
+                mm.register_models_from_db(db)
     finally:
         db.close() 
+    InferenceExecutor().start()
+    StatisticsBuffer().start()
+    DebugCapture().start()
+
+    # Warm-up in the background lets the server start answering /health/live right away
+    if settings.background_warm_up:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    else:
+        # A model that can't be loaded fails the startup instead of the first requests
+        warm_up(raise_errors=True)
+
+def warm_up(raise_errors: bool = False):
+    try:
+        with timed_phase("warm-up"):
+            import_heavy_modules()
+            with timed_phase("load models"):
+                ModelManager().preload_models()
+        StartupState().set_ready()
+    except Exception as e:
+        StartupState().fail(e)
+        if raise_errors:
+            raise
+
+@app.on_event("shutdown")
+def shutdown():
+    InferenceExecutor().shutdown()
+    # Pending model statistics are written before the process exits
+    StatisticsBuffer().shutdown()
+    DebugCapture().shutdown()
         
 
     
 api_router = APIRouter(prefix="/api/v1")
 api_router.include_router(predictions.router)
+api_router.include_router(live.router)
 api_router.include_router(models.router)
-app.include_router(api_router)
\ No newline at end of file
+app.include_router(api_router)
+app.include_router(health.router)
+app.include_router(metrics.router)
+app.include_router(debug.router)
\ No newline at end of file
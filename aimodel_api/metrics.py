@@ -0,0 +1,106 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+from prometheus_client import Counter, Gauge, Histogram
+
+# Buckets from 0.5 ms to 10 s, the stages range from fused tensor preparation to a cold model load
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGE_SECONDS = Histogram(
+    "aimodel_stage_duration_seconds", "Duration of the request stages (upload read, decode, vote)",
+    ["stage"], buckets=LATENCY_BUCKETS,
+)
+TRANSFORM_SECONDS = Histogram(
+    "aimodel_transform_duration_seconds", "Duration of a single transformation",
+    ["transform"], buckets=LATENCY_BUCKETS,
+)
+FORWARD_SECONDS = Histogram(
+    "aimodel_model_forward_duration_seconds", "Duration of the forward pass of a model, including the batching queue",
+    ["model_id"], buckets=LATENCY_BUCKETS,
+)
+NO_HAND_TOTAL = Counter(
+    "aimodel_no_hand_detected_total", "Images in which a transformation found no hand",
+    ["transform"],
+)
+HAND_GATE_TOTAL = Counter(
+    "aimodel_hand_gate_total", "Requests checked by the hand-presence gate",
+    ["result"],
+)
+CACHE_TOTAL = Counter(
+    "aimodel_prediction_cache_total", "Prediction cache lookups",
+    ["result"],
+)
+QUEUE_DEPTH = Gauge("aimodel_inference_queue_depth", "Jobs waiting in the inference executor queue")
+RUNNING_JOBS = Gauge("aimodel_inference_running_jobs", "Jobs running on the inference executor")
+CASCADE_MODELS = Histogram(
+    "aimodel_cascade_models_run", "Models run per request of the cascade ensemble",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10),
+)
+REJECTED_JOBS = Gauge("aimodel_inference_rejected_jobs", "Jobs rejected with 503 by the inference executor since startup")
+SHED_JOBS = Gauge("aimodel_inference_shed_jobs", "Queued jobs shed with 503 for jobs with earlier deadlines since startup")
+EXPIRED_JOBS = Gauge("aimodel_inference_expired_jobs", "Jobs failed with 504 because their deadline passed before they ran, since startup")
+
+
+# Exponential moving averages of the durations of the stages, transformations and forward passes across requests.
+# The cascade ensemble plans with them, a name that was never observed has no average
+class MovingAverages:
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._averages: dict[str, float] = {}
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            average = self._averages.get(name)
+            self._averages[name] = seconds if average is None else average + self.alpha * (seconds - average)
+
+    def get(self, name: str) -> Optional[float]:
+        with self._lock:
+            return self._averages.get(name)
+
+
+MEAN_SECONDS = MovingAverages()
+
+
+# Durations of the stages of a single request, reported in its Server-Timing header.
+# Stages that run several times (e.g. a model in the ensemble) are summed
+class RequestTimings:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations: dict[str, float] = {}
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def server_timing(self, total_seconds: float) -> str:
+        with self._lock:
+            entries = [f"{name};dur={1000 * seconds:.2f}" for name, seconds in self.durations.items()]
+        entries.append(f"total;dur={1000 * total_seconds:.2f}")
+        return ", ".join(entries)
+
+
+# Id and timings of the request being handled. Jobs on the inference executor and the ensemble run with a copy of the
+# context, so they add to the timings of the request they belong to
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+request_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+def record(name: str, seconds: float):
+    MEAN_SECONDS.observe(name, seconds)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def timed_stage(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(seconds)
+        record(stage, seconds)
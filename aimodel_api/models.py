@@ -18,6 +18,8 @@ class AiModelDto(BaseModel):
 # Response DTOs
 class PredictionResponseDto(BaseModel):
     prediction : Optional['GestureType'] = None
+    # Why prediction is None, e.g. no_hand_detected
+    reason: Optional[str] = None
 
 '''
  Enums
@@ -0,0 +1,142 @@
+# Pre-fork serving mode. The parent process loads all models once and forks the workers,
+# which share the model weights copy-on-write and accept connections on one shared socket.
+# Run from the aimodel_api directory (like `fastapi run main.py`):
+#   python prefork.py --workers 4 --port 8000
+#
+# TF can't run tf.function graphs or use its thread pools in a process forked after the runtime started,
+# so in this mode TF runs one intra-op/inter-op thread per worker and models are called eagerly.
+# Throughput scales with the number of workers instead of TF threads
+import argparse
+import gc
+import importlib
+import os
+import signal
+import socket
+import sys
+import time
+
+if __name__ == "__main__" and not __package__:
+    # Allow running the file as a script, the application uses relative imports
+    _package_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(_package_dir))
+    __package__ = os.path.basename(_package_dir)
+    importlib.import_module(__package__)
+
+from .config import settings
+
+
+def _prepare_settings():
+    settings.traced_inference = False
+    settings.lazy_model_loading = False
+    settings.background_warm_up = False
+    # TF runs one intra-op/inter-op thread per worker, the CPU affinity and OpenCV threads of the settings still apply
+    settings.tf_intra_op_threads = 1
+    settings.tf_inter_op_threads = 1
+
+
+def _load_models():
+    from .database.connection import create_tables, populate_database_if_empty, get_db
+    from .aimodel.aimodels import ModelManager
+    from .aimodel.transformations import TransformationType
+    from .startup import timed_phase, import_heavy_modules, apply_thread_topology
+
+    # Must run before the TF runtime starts
+    apply_thread_topology()
+
+    with timed_phase("parent warm-up"):
+        import_heavy_modules()
+        db = next(get_db())
+        try:
+            create_tables()
+            populate_database_if_empty(db)
+            mm = ModelManager()
+            mm.register_models_from_db(db)
+        finally:
+            db.close()
+        # MediaPipe graphs can't be built in a child if the parent built one, the workers build their own
+        mm.preload_models(skipped_transform_ids=[TransformationType.MP_HANDS.value])
+
+
+def _create_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(sock: socket.socket, host: str, port: int):
+    import uvicorn
+    from .main import app
+
+    config = uvicorn.Config(app, host=host, port=port, log_level="debug" if settings.debug else "info")
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def _fork_worker(sock: socket.socket, host: str, port: int) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            _run_worker(sock, host, port)
+        except BaseException as e:
+            print(f"Worker {os.getpid()} failed: {e}")
+            code = 1
+        finally:
+            os._exit(code)
+    print(f"Started worker {pid}.")
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the AI Model API with pre-forked workers sharing the loaded models")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=settings.prefork_workers)
+    args = parser.parse_args()
+
+    _prepare_settings()
+    _load_models()
+    # Import the application before forking, so the workers share it as well
+    from .main import app  # noqa: F401
+    sock = _create_socket(args.host, args.port)
+
+    # Objects created so far are never collected, so the GC doesn't touch (and copy) their pages in the workers
+    gc.collect()
+    gc.freeze()
+
+    workers = {_fork_worker(sock, args.host, args.port) for _ in range(args.workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        workers.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited with status {status}, restarting.")
+            time.sleep(1)
+            workers.add(_fork_worker(sock, args.host, args.port))
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
+
+from ..auth.jwt_handler import validate_token
+from ..debug_capture import DebugCapture, render_png
+
+router = APIRouter(
+    prefix="/debug",
+)
+
+tag = "Debug"
+
+@router.get("/captures", tags=[tag], summary="Get the captured requests (newest first) and the capture statistics")
+async def get_captures(res = Depends(validate_token)) -> dict:
+    debug_capture = DebugCapture()
+    return {"stats": debug_capture.stats(), "captures": debug_capture.summaries()}
+
+# From memory while the capture is in the buffer, afterwards from the written capture.json
+@router.get("/captures/{request_id}", tags=[tag], summary="Get the artifacts captured for a request")
+async def get_capture(request_id: str, res = Depends(validate_token)) -> dict:
+    current = DebugCapture().get(request_id)
+    if current is not None:
+        return current.summary()
+    summary = await run_in_threadpool(DebugCapture.written_summary, request_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Capture not found")
+    return summary
+
+# Rendered from memory while the capture is in the buffer, afterwards the written PNG preview is served
+@router.get("/captures/{request_id}/{name}", tags=[tag], summary="Get a captured artifact as a PNG image")
+async def get_artifact(request_id: str, name: str, res = Depends(validate_token)) -> Response:
+    current = DebugCapture().get(request_id)
+    if current is not None:
+        array = dict(current.items()).get(name)
+        if array is None:
+            raise HTTPException(status_code=404, detail="Artifact not found")
+        png = await run_in_threadpool(render_png, array)
+        if png is None:
+            raise HTTPException(status_code=415, detail="Artifact can't be shown as an image")
+        return Response(content=png, media_type="image/png")
+    try:
+        path = await run_in_threadpool(DebugCapture.written_preview, request_id, name)
+    except LookupError:
+        raise HTTPException(status_code=415, detail="Artifact can't be shown as an image")
+    if path is None:
+        raise HTTPException(status_code=404, detail="Artifact not found")
+    return FileResponse(path, media_type="image/png")
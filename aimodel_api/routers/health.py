@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from ..startup import StartupState
+
+router = APIRouter(
+    prefix="/health",
+)
+
+tag = "Health"
+
+@router.get("/live", tags=[tag], summary="Check if the service is running")
+async def live() -> dict:
+    return {"status": "alive"}
+
+@router.get("/ready", tags=[tag], summary="Check if the service finished warming up")
+async def ready() -> JSONResponse:
+    state = StartupState().snapshot()
+    return JSONResponse(status_code=200 if state["ready"] else 503, content=state)
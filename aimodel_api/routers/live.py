@@ -0,0 +1,165 @@
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect, status
+from starlette.concurrency import run_in_threadpool
+from typing import Optional
+import asyncio
+import threading
+import time
+import numpy as np
+
+from ..auth.jwt_handler import validate_websocket_token
+from ..config import settings
+from ..models import GestureType
+from ..aimodel.aimodels import ModelManager
+from ..aimodel.executor import InferenceExecutor
+from ..aimodel.image_decoding import decode_image
+from ..metrics import timed_stage
+from ..aimodel.transformations import Transformations, TransformationType, TrackingHands, tracking_hands
+
+router = APIRouter(
+    prefix="/predictions",
+)
+
+tag = "Live"
+
+
+# Number of open live sessions in this worker process, limited to live_max_sessions
+class LiveSessions:
+    _instance = None
+
+    # Singleton
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(LiveSessions, cls).__new__(cls, *args, **kwargs)
+            cls._instance._lock = threading.Lock()
+            cls._instance.open_sessions = 0
+            cls._instance.rejected = 0
+        return cls._instance
+
+    def try_open(self) -> bool:
+        with self._lock:
+            if self.open_sessions >= settings.live_max_sessions:
+                self.rejected += 1
+                return False
+            self.open_sessions += 1
+            return True
+
+    def close(self):
+        with self._lock:
+            self.open_sessions -= 1
+
+
+# Frames of a live session. Only the latest frame is kept, a frame that arrives before the previous one
+# was taken for processing replaces it (the stale frame is dropped)
+class LiveSession:
+    def __init__(self):
+        self.latest: Optional[bytes] = None
+        self.received = 0
+        self.dropped = 0
+        self.closed = False
+        self.frame_ready = asyncio.Event()
+
+    def put(self, frame: bytes):
+        if self.latest is not None:
+            self.dropped += 1
+        self.latest = frame
+        self.received += 1
+        self.frame_ready.set()
+
+    def close(self):
+        self.closed = True
+        self.frame_ready.set()
+
+    async def take(self) -> Optional[tuple[int, bytes]]:
+        await self.frame_ready.wait()
+        self.frame_ready.clear()
+        if self.closed:
+            return None
+        frame, self.latest = self.latest, None
+        return self.received, frame
+
+
+# Streams camera frames and receives a prediction for each processed frame.
+# The client sends frames as binary messages (encoded images), the server answers with JSON messages:
+# {"frame": n, "prediction": 0-2 or null, "reason": ... or null, "latency_ms": ..., "dropped": ...} or {"frame": n, "status_code": ..., "error": ...}.
+# Frames sent faster than the server can process them are dropped, only the latest one is predicted.
+# MediaPipe runs in tracking mode within the session
+@router.websocket("/live")
+async def live(websocket: WebSocket, model_id: int, res = Depends(validate_websocket_token)):
+    # Accepted before it's closed, so the client gets the close code and reason instead of a rejected handshake
+    if model_id != -1 and model_id not in ModelManager().registered_models:
+        await websocket.accept()
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=f"Model {model_id} not found.")
+        return
+    if not LiveSessions().try_open():
+        await websocket.accept()
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="Too many live sessions, try again later.")
+        return
+
+    session_hands = TrackingHands(
+        min_detection_confidence=Transformations.get_transform(TransformationType.MP_HANDS.value).min_detection_confidence,
+        min_tracking_confidence=settings.live_min_tracking_confidence,
+    )
+    # Inference jobs submitted from this connection run with the context copied at submit, so they use the session graph
+    tracking_hands.set(session_hands)
+    session = LiveSession()
+    try:
+        await websocket.accept()
+        receiver = asyncio.create_task(_receive_frames(websocket, session))
+        try:
+            while (frame := await session.take()) is not None:
+                frame_number, content = frame
+                await websocket.send_json(await _process_frame(model_id, frame_number, content, session))
+        except WebSocketDisconnect:
+            pass
+        finally:
+            receiver.cancel()
+    finally:
+        LiveSessions().close()
+        await run_in_threadpool(session_hands.close)
+
+async def _receive_frames(websocket: WebSocket, session: LiveSession):
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                session.put(message["bytes"])
+    finally:
+        session.close()
+
+async def _process_frame(model_id: int, frame_number: int, content: bytes, session: LiveSession) -> dict:
+    start = time.perf_counter()
+    try:
+        if len(content) > settings.max_upload_bytes:
+            raise HTTPException(status_code=413, detail="Image file is too large")
+        # A frame is worth predicting only shortly after it arrived
+        deadline = time.monotonic() + settings.live_frame_deadline_ms / 1000 if settings.live_frame_deadline_ms > 0 else None
+        prediction, reason = await InferenceExecutor().run(_predict_frame, model_id, content, deadline=deadline)
+    except HTTPException as e:
+        return {"frame": frame_number, "status_code": e.status_code, "error": e.detail}
+    except Exception as e:
+        return {"frame": frame_number, "status_code": 500, "error": str(e)}
+    return {
+        "frame": frame_number,
+        "prediction": prediction.value if prediction is not None else None,
+        "reason": reason,
+        "latency_ms": round(1000 * (time.perf_counter() - start), 2),
+        "dropped": session.dropped,
+    }
+
+# Prediction of the frame, or None and the reason the frame was rejected by the hand-presence gate
+def _predict_frame(model_id: int, content: bytes) -> tuple[Optional[GestureType], Optional[str]]:
+    model_manager = ModelManager()
+    with timed_stage("decode"):
+        image = decode_image(content, model_manager.decode_size(model_id))
+    transformed, reason = model_manager.check_hand_presence(image, model_id)
+    if reason is not None:
+        return None, reason
+    if model_id == -1:
+        predicted_class, _ = model_manager.predict_all(image, transformed)
+        return predicted_class, None
+    prediction = model_manager.predict(model_id, image, transformed)
+    if prediction is None:
+        return None, None
+    return GestureType(np.argmax(prediction)), None
@@ -0,0 +1,22 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from ..aimodel.executor import InferenceExecutor
+from ..metrics import QUEUE_DEPTH, RUNNING_JOBS, REJECTED_JOBS, SHED_JOBS, EXPIRED_JOBS
+
+router = APIRouter(
+    prefix="/metrics",
+)
+
+tag = "Metrics"
+
+# The executor keeps its own counters, they are read when the metrics are scraped
+QUEUE_DEPTH.set_function(lambda: InferenceExecutor().stats()["queued"])
+RUNNING_JOBS.set_function(lambda: InferenceExecutor().stats()["running"])
+REJECTED_JOBS.set_function(lambda: InferenceExecutor().stats()["rejected"])
+SHED_JOBS.set_function(lambda: InferenceExecutor().stats()["shed"])
+EXPIRED_JOBS.set_function(lambda: InferenceExecutor().stats()["expired"])
+
+@router.get("", tags=[tag], summary="Get the metrics in the Prometheus text format")
+async def metrics() -> Response:
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
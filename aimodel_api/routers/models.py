@@ -1,9 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 
-from ..database.connection import db_dependency
-from ..database.models import Model
+from ..database.catalogue import ModelCatalogue
+from ..database.statistics_buffer import StatisticsBuffer
+from ..aimodel.aimodels import ModelManager
 from ..models import AiModelDto
 from ..auth.jwt_handler import validate_token
 
@@ -13,20 +13,22 @@ router = APIRouter(
 
 tag = "Models"
 
-@router.get("", tags=[tag], summary="Get all models")
-async def get_models(db_session : db_dependency, res = Depends(validate_token)) -> list[AiModelDto]:
-    models_db = db_session.scalars(
-        select(Model).order_by(Model.id)
-    ).all()
-    return [AiModelDto.from_orm(model) for model in models_db]
+@router.get("", tags=[tag], summary="Get all models", response_model=list[AiModelDto])
+async def get_models(request: Request, res = Depends(validate_token)) -> Response:
+    # Served from the pre-serialized catalogue, 304 if the client already has this version
+    catalogue = ModelCatalogue()
+    # The snapshot is built when the models are registered, the database is only queried (off the event loop) if it's missing
+    snapshot = catalogue.current or await run_in_threadpool(catalogue.snapshot)
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if snapshot.matches(request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
 
 @router.put("/statistics", tags=[tag], summary="Update the statistics of a model")
-async def update_model_statistics(model_id: int, wrong_prediction: bool, db_session : db_dependency, res = Depends(validate_token)) -> bool:
-    model = db_session.get(Model, model_id)
-    if model is None:
+async def update_model_statistics(model_id: int, wrong_prediction: bool, res = Depends(validate_token)) -> bool:
+    # Models are registered from the database at startup, no query is needed on the event loop
+    if model_id not in ModelManager().registered_models:
         raise HTTPException(status_code=404, detail="Model not found")
-    model.statistics.total_predictions += 1
-    if wrong_prediction:
-        model.statistics.wrong_predictions += 1
-    db_session.commit()
+    # Written to the database in the background, see StatisticsBuffer
+    StatisticsBuffer().add(model_id, wrong_prediction)
     return True
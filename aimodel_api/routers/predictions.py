@@ -1,12 +1,23 @@
-from fastapi import APIRouter, Depends, File, UploadFile, HTTPException
+from fastapi import APIRouter, Depends, File, UploadFile, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.datastructures import FormData
 from PIL import Image
-from io import BytesIO  
+from typing import AsyncIterator, Callable, Iterator, Optional
+import asyncio
+from collections import deque
+from itertools import islice
+import json
+import zipfile
 import numpy as np
 
 from ..auth.jwt_handler import validate_token
 from ..config import settings
 from ..models import PredictionResponseDto, GestureType
 from ..aimodel.aimodels import ModelManager
+from ..aimodel.executor import InferenceExecutor, deadline_from_headers
+from ..aimodel.image_decoding import decode_image
+from ..metrics import CACHE_TOTAL, timed_stage
+from ..debug_capture import capture
 
 router = APIRouter(
     prefix="/predictions",
@@ -15,28 +26,208 @@ router = APIRouter(
 tag = "Predictions"
 
 @router.post("", tags=[tag], summary="Predict the gesture in the image", response_model=PredictionResponseDto)
-async def predict(model_id: int, file: UploadFile = File(...), res = Depends(validate_token)) -> PredictionResponseDto:
-    image = _read_image(file)
+async def predict(model_id: int, request: Request, file: UploadFile = File(...), res = Depends(validate_token)) -> PredictionResponseDto:
+    deadline = deadline_from_headers(request.headers, settings.prediction_deadline_ms)
+    # Reading one byte over the limit is enough to reject the upload
+    with timed_stage("read"):
+        content = await file.read(settings.max_upload_bytes + 1)
+    if len(content) > settings.max_upload_bytes:
+        raise HTTPException(status_code=413, detail="Image file is too large")
+    cache_key, cached_response = _cached_prediction(model_id, content)
+    if cached_response is not None:
+        return cached_response
+    # Decoding and inference are blocking, they run on the inference executor
+    return await InferenceExecutor().run(_predict, model_id, content, cache_key, deadline=deadline)
 
+# The form is parsed in the endpoint, FastAPI would close the uploaded files before the response is streamed
+@router.post(
+    "/batch",
+    tags=[tag],
+    summary="Predict the gestures in many images (multipart files or zip archives), results are streamed as NDJSON",
+    response_class=StreamingResponse,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {"files": {"type": "array", "items": {"type": "string", "format": "binary"}}},
+                        "required": ["files"],
+                    }
+                }
+            },
+        }
+    },
+)
+async def predict_batch(model_id: int, request: Request, res = Depends(validate_token)) -> StreamingResponse:
     model_manager = ModelManager()
-    if model_id == -1:
-        return _predict_with_all(model_manager, image)
-    
-    prediction = model_manager.predict(model_id, image)
+    if model_id != -1 and model_id not in model_manager.registered_models:
+        raise HTTPException(status_code=404, detail=f"Model {model_id} not found.")
+    deadline = deadline_from_headers(request.headers, settings.batch_deadline_ms)
+    try:
+        form = await request.form(max_files=settings.batch_max_items)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid multipart request")
+    uploads = [value for _, value in form.multi_items() if not isinstance(value, str)]
+    if not uploads:
+        await form.close()
+        raise HTTPException(status_code=400, detail="No files uploaded")
+    return StreamingResponse(_stream_batch(model_id, form, uploads, deadline), media_type="application/x-ndjson")
+
+@router.get("/stats", tags=[tag], summary="Get the inference statistics")
+async def get_stats(res = Depends(validate_token)) -> dict:
+    model_manager = ModelManager()
+    return {
+        "executor": InferenceExecutor().stats(),
+        "batching": model_manager.batching_stats(),
+        "cache": model_manager.prediction_cache.stats(),
+        "residency": model_manager.residency.stats(),
+    }
+
+# Cache key of the upload and its cached response (None on a miss). The lookup runs in the request handler,
+# so cache hits don't queue on the inference executor
+def _cached_prediction(model_id: int, content: bytes) -> tuple[tuple, Optional[PredictionResponseDto]]:
+    model_manager = ModelManager()
+    cache_key = model_manager.prediction_cache_key(model_id, content)
+    hit, cached_response = model_manager.prediction_cache.get(cache_key)
+    CACHE_TOTAL.labels("hit" if hit else "miss").inc()
+    return cache_key, cached_response if hit else None
+
+# The response is cached under cache_key if one is given
+def _predict(model_id: int, content: bytes, cache_key: Optional[tuple] = None) -> PredictionResponseDto:
+    model_manager = ModelManager()
+    with timed_stage("decode"):
+        image = decode_image(content, model_manager.decode_size(model_id))
+    capture("decoded", image)
+    # Images without a hand are answered without running the models
+    transformed, reason = model_manager.check_hand_presence(image, model_id)
+    partial = False
+    if reason is not None:
+        response = PredictionResponseDto(prediction=None, reason=reason)
+    elif model_id == -1:
+        response, partial = _predict_with_all(model_manager, image, transformed)
+    else:
+        response = _predict_with_model(model_manager, model_id, image, transformed)
+
+    # A partial ensemble answer is not cached, the next request for the image gets the vote of all models
+    if cache_key is not None and not partial:
+        model_manager.prediction_cache.put(cache_key, response)
+    return response
+
+# Batch item: index, file name and a function reading its content (None and an error if it can't be read)
+BatchItem = tuple[int, str, Optional[Callable[[], bytes]], Optional[HTTPException]]
+
+def _batch_items(uploads: list) -> Iterator[BatchItem]:
+    index = 0
+    for upload in uploads:
+        filename = upload.filename or ""
+        if filename.lower().endswith(".zip") or upload.content_type in ("application/zip", "application/x-zip-compressed"):
+            try:
+                archive = zipfile.ZipFile(upload.file)
+            except zipfile.BadZipFile:
+                yield index, filename, None, HTTPException(status_code=400, detail="Invalid zip archive")
+                index += 1
+                continue
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                if info.file_size > settings.max_upload_bytes:
+                    yield index, info.filename, None, HTTPException(status_code=413, detail="Image file is too large")
+                else:
+                    yield index, info.filename, lambda archive=archive, info=info: archive.read(info), None
+                index += 1
+        else:
+            if upload.size is not None and upload.size > settings.max_upload_bytes:
+                yield index, filename, None, HTTPException(status_code=413, detail="Image file is too large")
+            else:
+                yield index, filename, lambda file=upload.file: _read_from_start(file), None
+            index += 1
+
+# Reads the whole file, also when the item is submitted again after it was shed
+def _read_from_start(file) -> bytes:
+    file.seek(0)
+    return file.read()
+
+def _batch_line(index: int, filename: str, response: Optional[PredictionResponseDto] = None, error: Optional[Exception] = None) -> bytes:
+    line = {"index": index, "filename": filename}
+    if error is None:
+        line.update(response.model_dump(mode="json"))
+    elif isinstance(error, HTTPException):
+        line.update(status_code=error.status_code, error=error.detail)
+    else:
+        line.update(status_code=500, error=str(error))
+    return (json.dumps(line) + "\n").encode()
+
+# Runs at most batch_prediction_window images at once and yields their results as they finish (in any order),
+# so only the images in flight are held in memory. Concurrent images share the batched forward passes of the models.
+# Cached images are answered without submitting them. Images shed by the executor in favour of requests
+# with earlier deadlines are read and submitted again
+async def _stream_batch(model_id: int, form: FormData, uploads: list, deadline: Optional[float] = None) -> AsyncIterator[bytes]:
+    executor = InferenceExecutor()
+    items = islice(_batch_items(uploads), settings.batch_max_items)
+    in_flight = {}
+    shed: deque[BatchItem] = deque()
+    waiting: Optional[BatchItem] = None
+    exhausted = False
+    try:
+        while not exhausted or waiting is not None or shed or in_flight:
+            while len(in_flight) < settings.batch_prediction_window and (waiting is not None or shed or not exhausted):
+                item = waiting or (shed.popleft() if shed else next(items, None))
+                waiting = None
+                if item is None:
+                    exhausted = True
+                    break
+                index, filename, read, error = item
+                if error is not None:
+                    yield _batch_line(index, filename, error=error)
+                    continue
+                content = read()
+                cache_key, cached_response = _cached_prediction(model_id, content)
+                if cached_response is not None:
+                    yield _batch_line(index, filename, cached_response)
+                    continue
+                try:
+                    future = asyncio.wrap_future(executor.submit(_predict, model_id, content, cache_key, deadline=deadline))
+                except HTTPException as e:
+                    if e.status_code != 503:
+                        # e.g. the deadline of the batch passed
+                        yield _batch_line(index, filename, error=e)
+                        continue
+                    # The executor is full, the image is submitted again once a slot is free
+                    waiting = item
+                    break
+                in_flight[future] = item
+
+            if not in_flight:
+                if waiting is not None or shed:
+                    await asyncio.sleep(settings.inference_retry_after_s)
+                continue
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                item = in_flight.pop(future)
+                index, filename = item[0], item[1]
+                error = future.exception()
+                if isinstance(error, HTTPException) and error.status_code == 503:
+                    shed.append(item)
+                elif error is not None:
+                    yield _batch_line(index, filename, error=error)
+                else:
+                    yield _batch_line(index, filename, future.result())
+    finally:
+        for future in in_flight:
+            future.cancel()
+        await form.close()
+
+def _predict_with_model(model_manager: ModelManager, model_id: int, image: Image.Image, transformed: dict) -> PredictionResponseDto:
+    prediction = model_manager.predict(model_id, image, transformed)
     if prediction is None:
         return PredictionResponseDto(prediction=None)
     predicted_class = GestureType(np.argmax(prediction))
 
     return PredictionResponseDto(prediction=predicted_class)
 
-def _read_image(file: UploadFile) -> Image.Image:
-    try:
-        content = file.file.read()  
-        image = Image.open(BytesIO(content)) 
-    except Exception as e:
-        raise HTTPException(status_code=400, detail="Invalid image file")
-    return image
-
-def _predict_with_all(model_manager: ModelManager, image: Image.Image) -> PredictionResponseDto:
-    predicted_class = model_manager.predict_all(image)
-    return PredictionResponseDto(prediction=predicted_class)
\ No newline at end of file
+# Returns the response and whether it is partial, see ModelManager.predict_all
+def _predict_with_all(model_manager: ModelManager, image: Image.Image, transformed: dict) -> tuple[PredictionResponseDto, bool]:
+    predicted_class, partial = model_manager.predict_all(image, transformed)
+    return PredictionResponseDto(prediction=predicted_class), partial
\ No newline at end of file
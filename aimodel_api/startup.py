@@ -0,0 +1,95 @@
+import importlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .config import settings
+
+# Heavy dependencies imported on first use, imported up front during warm-up
+HEAVY_MODULES = ("tensorflow", "cv2", "mediapipe")
+
+
+# Readiness of the service and the duration of the startup phases
+class StartupState:
+    _instance = None
+
+    # Singleton
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(StartupState, cls).__new__(cls, *args, **kwargs)
+            cls._instance._lock = threading.Lock()
+            cls._instance.ready = False
+            cls._instance.error = None
+            cls._instance.phases = {}
+        return cls._instance
+
+    def record_phase(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = seconds
+        print(f"Startup phase '{name}' took {seconds:.2f}s.")
+
+    def set_ready(self):
+        self.ready = True
+        print("Service is ready.")
+
+    def fail(self, error: Exception):
+        self.error = str(error)
+        print(f"Warm-up failed: {error}")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "error": self.error,
+                "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            }
+
+
+@contextmanager
+def timed_phase(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        StartupState().record_phase(name, time.perf_counter() - start)
+
+
+def import_heavy_modules():
+    for module in HEAVY_MODULES:
+        with timed_phase(f"import {module}"):
+            importlib.import_module(module)
+
+
+# Sizes the TF and OpenCV thread pools and pins the process to the CPUs of the settings. Every library sizes its pool
+# to all cores on its own, which oversubscribes the CPU next to the inference workers and other tenants of the node.
+# Must run before the models load, the TF pools can't be resized once the runtime started
+def apply_thread_topology():
+    if settings.cpu_affinity and hasattr(os, "sched_setaffinity"):
+        cpus = set(settings.cpu_affinity)
+        # The affinity of a thread is inherited by the threads it starts, threads already running are pinned one by one
+        tasks = os.listdir("/proc/self/task") if os.path.isdir("/proc/self/task") else ["0"]
+        for task in tasks:
+            try:
+                os.sched_setaffinity(int(task), cpus)
+            except ProcessLookupError:
+                pass
+        print(f"Process pinned to CPUs {sorted(os.sched_getaffinity(0))}.")
+    # Nothing is imported for the settings left at the library defaults, the heavy modules are imported during warm-up
+    if settings.tf_intra_op_threads > 0 or settings.tf_inter_op_threads > 0:
+        import tensorflow as tf
+
+        try:
+            if settings.tf_intra_op_threads > 0:
+                tf.config.threading.set_intra_op_parallelism_threads(settings.tf_intra_op_threads)
+            if settings.tf_inter_op_threads > 0:
+                tf.config.threading.set_inter_op_parallelism_threads(settings.tf_inter_op_threads)
+        except RuntimeError as e:
+            print(f"Could not set the TF thread pools: {e}")
+        print(f"TF threads: intra-op {tf.config.threading.get_intra_op_parallelism_threads()}, "
+              f"inter-op {tf.config.threading.get_inter_op_parallelism_threads()}.")
+    if settings.opencv_threads >= 0:
+        import cv2
+
+        cv2.setNumThreads(settings.opencv_threads)
+        print(f"OpenCV threads: {cv2.getNumThreads()}.")
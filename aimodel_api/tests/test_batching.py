@@ -0,0 +1,60 @@
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from ..aimodel.batching import BatchingQueue
+
+
+class BatchingQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.running = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def tearDown(self):
+        self.release.set()
+        self.queue.close()
+
+    def _predict(self, inputs: np.ndarray) -> np.ndarray:
+        self.batches.append(len(inputs))
+        self.running.set()
+        self.release.wait()
+        return inputs * 2
+
+    def test_lone_request_doesnt_wait_for_the_batch(self):
+        self.queue = BatchingQueue("test", self._predict, max_batch_size=16, max_wait_ms=10_000)
+        start = time.perf_counter()
+        result = self.queue.predict(np.ones((1, 2)))
+        self.assertLess(time.perf_counter() - start, 5)
+        np.testing.assert_array_equal(result, np.full((1, 2), 2))
+
+    def test_requests_queued_during_a_forward_pass_run_as_one_batch(self):
+        self.queue = BatchingQueue("test", self._predict, max_batch_size=16, max_wait_ms=10_000)
+        self.release.clear()
+        first = self.queue.submit(np.zeros((1, 2)))
+        self.running.wait(timeout=5)
+        queued = [self.queue.submit(np.full((1, 2), value)) for value in range(1, 4)]
+        self.release.set()
+        first.result(timeout=5)
+        for value, future in enumerate(queued, start=1):
+            np.testing.assert_array_equal(future.result(timeout=5), np.full((1, 2), 2 * value))
+        self.assertEqual(self.batches, [1, 3])
+        self.assertEqual(self.queue.stats.snapshot()["batch_sizes"], {1: 1, 3: 1})
+
+    def test_batch_is_split_at_max_batch_size(self):
+        self.queue = BatchingQueue("test", self._predict, max_batch_size=2, max_wait_ms=10_000)
+        self.release.clear()
+        first = self.queue.submit(np.zeros((1, 2)))
+        self.running.wait(timeout=5)
+        queued = [self.queue.submit(np.zeros((1, 2))) for _ in range(3)]
+        self.release.set()
+        for future in [first] + queued:
+            future.result(timeout=5)
+        self.assertEqual(self.batches, [1, 2, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
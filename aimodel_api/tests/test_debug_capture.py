@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from ..config import settings
+from ..debug_capture import DebugCapture, RequestCapture, capture, request_capture
+
+
+class DebugCaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.saved = {name: getattr(settings, name) for name in ("debug", "debug_capture_rate", "debug_capture_buffer_size", "debug_capture_folder")}
+        settings.debug = True
+        settings.debug_capture_rate = 1.0
+        settings.debug_capture_buffer_size = 2
+        settings.debug_capture_folder = self.folder.name
+        DebugCapture._instance = None
+        self.debug_capture = DebugCapture()
+
+    def tearDown(self):
+        request_capture.set(None)
+        self.debug_capture.shutdown()
+        DebugCapture._instance = None
+        for name, value in self.saved.items():
+            setattr(settings, name, value)
+        self.folder.cleanup()
+
+    def _finished(self, current_id: str) -> RequestCapture:
+        current = RequestCapture(current_id)
+        current.add("decoded", np.zeros((4, 4, 3), dtype=np.uint8))
+        self.debug_capture.finish(current)
+        return current
+
+    def test_oldest_capture_is_evicted_and_counted_as_dropped(self):
+        for current_id in ("a", "b", "c"):
+            self._finished(current_id)
+        self.assertIsNone(self.debug_capture.get("a"))
+        self.assertEqual([summary["request_id"] for summary in self.debug_capture.summaries()], ["c", "b"])
+        stats = self.debug_capture.stats()
+        self.assertEqual((stats["buffered"], stats["captured"], stats["dropped"]), (2, 3, 1))
+
+    def test_written_capture_is_not_dropped(self):
+        self._finished("a").written = True
+        self._finished("b")
+        self._finished("c")
+        self.assertEqual(self.debug_capture.stats()["dropped"], 0)
+
+    def test_repeated_artifacts_get_numbered_names(self):
+        current = RequestCapture("a")
+        token = request_capture.set(current)
+        try:
+            capture("model_input", np.zeros(3))
+            capture("model_input", np.ones(3))
+            capture("skipped", None)
+        finally:
+            request_capture.reset(token)
+        self.assertEqual([name for name, _ in current.items()], ["model_input", "model_input_2"])
+
+    def test_request_ids_are_sanitized(self):
+        current = self.debug_capture.begin("../../etc")
+        self.assertEqual(current.request_id, "______etc")
+
+    def test_evicted_capture_is_read_from_the_disk(self):
+        current = self._finished("a")
+        current.add("model_output", np.zeros((1, 3), dtype=np.float32))
+        DebugCapture._write(current)
+        self._finished("b")
+        self._finished("c")
+
+        summary = DebugCapture.written_summary("a")
+        self.assertTrue(summary["written"])
+        self.assertEqual([artifact["name"] for artifact in summary["artifacts"]], ["decoded", "model_output"])
+        self.assertEqual(DebugCapture.written_preview("a", "decoded"), os.path.join(os.path.realpath(self.folder.name), "a", "00_decoded.png"))
+        # Written without a PNG preview
+        with self.assertRaises(LookupError):
+            DebugCapture.written_preview("a", "model_output")
+        self.assertIsNone(DebugCapture.written_preview("a", "missing"))
+        self.assertIsNone(DebugCapture.written_preview("a", "capture.json"))
+        self.assertIsNone(DebugCapture.written_summary("../a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+# Run from the repository root: python -m unittest discover -s aimodel_api/tests -t .
+import unittest
+
+import numpy as np
+
+from ..aimodel.ensemble import CascadeVote, EnsembleVote
+from ..models import GestureType
+
+
+class EnsembleVoteTest(unittest.TestCase):
+    def test_done_when_all_models_voted(self):
+        vote = EnsembleVote([1, 2, 3], early_exit=False)
+        vote.add(1, GestureType.ROCK)
+        vote.add(2, GestureType.PAPER)
+        self.assertFalse(vote.done.is_set())
+        vote.add(3, GestureType.ROCK)
+        self.assertTrue(vote.done.is_set())
+        self.assertEqual(vote.predictions, {1: GestureType.ROCK, 2: GestureType.PAPER, 3: GestureType.ROCK})
+
+    def test_early_exit_once_the_majority_cant_change(self):
+        vote = EnsembleVote([1, 2, 3, 4, 5])
+        vote.add(1, GestureType.ROCK)
+        vote.add(2, GestureType.ROCK)
+        # 2 votes against 0 with 3 pending, the pending models could still win
+        self.assertFalse(vote.done.is_set())
+        vote.add(3, GestureType.ROCK)
+        self.assertTrue(vote.done.is_set())
+        self.assertEqual(vote.pending, {4, 5})
+
+    def test_no_early_exit_on_a_possible_tie(self):
+        vote = EnsembleVote([1, 2, 3, 4])
+        vote.add(1, GestureType.ROCK)
+        vote.add(2, GestureType.ROCK)
+        self.assertFalse(vote.done.is_set())
+
+    def test_models_without_a_prediction_dont_vote(self):
+        vote = EnsembleVote([1, 2, 3])
+        vote.add(1, None)
+        vote.add(2, GestureType.SCISSORS)
+        vote.add(3, None)
+        self.assertTrue(vote.done.is_set())
+        self.assertEqual(vote.predictions, {2: GestureType.SCISSORS})
+
+    def test_without_models_the_vote_is_done(self):
+        self.assertTrue(EnsembleVote([]).done.is_set())
+
+    def test_failure_stops_the_vote(self):
+        vote = EnsembleVote([1, 2])
+        error = RuntimeError("model failed")
+        vote.fail(error)
+        vote.fail(RuntimeError("second failure"))
+        self.assertTrue(vote.done.is_set())
+        self.assertIs(vote.error, error)
+
+    def test_expired_model_stops_the_vote_with_the_votes_so_far(self):
+        vote = EnsembleVote([1, 2, 3], early_exit=False)
+        vote.add(1, GestureType.PAPER)
+        error = RuntimeError("deadline exceeded")
+        vote.expire(2, error)
+        self.assertTrue(vote.done.is_set())
+        self.assertIs(vote.expired, error)
+        self.assertIsNone(vote.error)
+        self.assertEqual(vote.predictions, {1: GestureType.PAPER})
+
+
+# Softmax outputs in the order of the GestureType values: paper, rock, scissors
+def probabilities(paper: float, rock: float, scissors: float) -> np.ndarray:
+    return np.array([[paper, rock, scissors]], dtype=np.float32)
+
+
+class CascadeVoteTest(unittest.TestCase):
+    def test_vote_weight_is_margin_times_accuracy(self):
+        vote = CascadeVote(threshold=0.8)
+        vote.add(1, probabilities(0.1, 0.7, 0.2), accuracy=0.5)
+        self.assertEqual(vote.elected(), GestureType.ROCK)
+        self.assertAlmostEqual(vote.scores[GestureType.ROCK], (0.7 - 0.2) * 0.5, places=5)
+
+    def test_done_once_confident(self):
+        vote = CascadeVote(threshold=0.8)
+        vote.add(1, probabilities(0.0, 1.0, 0.0), accuracy=0.9)
+        self.assertTrue(vote.done(remaining_weight=5.0))
+
+    def test_not_done_while_the_remaining_models_could_change_the_result(self):
+        vote = CascadeVote(threshold=0.8)
+        vote.add(1, probabilities(0.1, 0.6, 0.3), accuracy=0.9)
+        self.assertFalse(vote.done(remaining_weight=1.0))
+        # The lead can't be overturned by models with less weight in total
+        self.assertTrue(vote.done(remaining_weight=0.1))
+
+    def test_confidence_is_the_lead_over_the_runner_up(self):
+        vote = CascadeVote(threshold=0.8)
+        vote.add(1, probabilities(0.0, 1.0, 0.0), accuracy=0.8)
+        vote.add(2, probabilities(1.0, 0.0, 0.0), accuracy=0.5)
+        self.assertEqual(vote.elected(), GestureType.ROCK)
+        self.assertAlmostEqual(vote.confidence(), 0.3, places=5)
+
+    def test_empty_vote(self):
+        vote = CascadeVote(threshold=0.8)
+        self.assertIsNone(vote.elected())
+        self.assertFalse(vote.done(remaining_weight=0.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
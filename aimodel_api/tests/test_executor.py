@@ -0,0 +1,134 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from fastapi import HTTPException
+
+from ..aimodel.executor import (
+    DEADLINE_HEADER,
+    InferenceExecutor,
+    check_deadline,
+    deadline_from_headers,
+    extend_deadline,
+    request_deadline,
+)
+from ..config import settings
+
+
+class DeadlineTest(unittest.TestCase):
+    def tearDown(self):
+        request_deadline.set(None)
+
+    @mock.patch("time.monotonic", return_value=100.0)
+    def test_header_budget_in_milliseconds(self, _):
+        self.assertEqual(deadline_from_headers({DEADLINE_HEADER: "250"}, 5000), 100.25)
+
+    @mock.patch("time.monotonic", return_value=100.0)
+    def test_default_budget_without_the_header(self, _):
+        self.assertEqual(deadline_from_headers({}, 5000), 105.0)
+        self.assertIsNone(deadline_from_headers({}, 0))
+
+    @mock.patch("time.monotonic", return_value=100.0)
+    def test_header_overrides_the_disabled_default(self, _):
+        self.assertEqual(deadline_from_headers({DEADLINE_HEADER: "0"}, 0), 100.0)
+
+    def test_invalid_header_is_rejected(self):
+        for value in ("abc", "nan", "inf", ""):
+            with self.subTest(value=value), self.assertRaises(HTTPException) as raised:
+                deadline_from_headers({DEADLINE_HEADER: value}, 5000)
+            self.assertEqual(raised.exception.status_code, 400)
+
+    def test_check_deadline(self):
+        check_deadline()
+        request_deadline.set(time.monotonic() + 60)
+        check_deadline()
+        request_deadline.set(time.monotonic() - 1)
+        with self.assertRaises(HTTPException) as raised:
+            check_deadline()
+        self.assertEqual(raised.exception.status_code, 504)
+
+    def test_extended_deadline(self):
+        request_deadline.set(time.monotonic() - 1)
+        extend_deadline(60)
+        check_deadline()
+
+
+class InferenceExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (settings.inference_workers, settings.inference_queue_size)
+        settings.inference_workers = 1
+        settings.inference_queue_size = 3
+        InferenceExecutor._instance = None
+        self.executor = InferenceExecutor()
+        # The only worker waits until the test releases it, the other jobs stay queued
+        self.release = threading.Event()
+        self.blocker = self.executor.submit(self.release.wait)
+        while self.executor.stats()["running"] == 0:
+            time.sleep(0.001)
+        self.order = []
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.shutdown()
+        InferenceExecutor._instance = None
+        settings.inference_workers, settings.inference_queue_size = self.saved
+
+    def _submit(self, name: str, deadline_s: float = None):
+        deadline = time.monotonic() + deadline_s if deadline_s is not None else None
+        return self.executor.submit(self.order.append, name, deadline=deadline)
+
+    def _status_code(self, future) -> int:
+        with self.assertRaises(HTTPException) as raised:
+            future.result(timeout=5)
+        return raised.exception.status_code
+
+    def test_jobs_run_earliest_deadline_first(self):
+        futures = [self._submit("none"), self._submit("late", 60), self._submit("soon", 30)]
+        self.release.set()
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(self.order, ["soon", "late", "none"])
+
+    def test_job_runs_with_the_deadline_of_its_request(self):
+        deadline = time.monotonic() + 60
+        future = self.executor.submit(request_deadline.get, deadline=deadline)
+        self.release.set()
+        self.assertEqual(future.result(timeout=5), deadline)
+
+    def test_full_queue_sheds_the_latest_deadline(self):
+        shed = self._submit("none")
+        kept = [self._submit("late", 60), self._submit("soon", 30)]
+        urgent = self._submit("urgent", 10)
+        self.assertEqual(self._status_code(shed), 503)
+        self.release.set()
+        for future in kept + [urgent]:
+            future.result(timeout=5)
+        self.assertEqual(self.order, ["urgent", "soon", "late"])
+        self.assertEqual(self.executor.stats()["shed"], 1)
+
+    def test_full_queue_rejects_a_later_deadline(self):
+        for deadline_s in (10, 20, 30):
+            self._submit("queued", deadline_s)
+        with self.assertRaises(HTTPException) as raised:
+            self._submit("late", 60)
+        self.assertEqual(raised.exception.status_code, 503)
+        self.assertIn("Retry-After", raised.exception.headers)
+        self.assertEqual(self.executor.stats()["rejected"], 1)
+
+    def test_expired_job_is_rejected_at_submit(self):
+        with self.assertRaises(HTTPException) as raised:
+            self._submit("expired", -1)
+        self.assertEqual(raised.exception.status_code, 504)
+
+    def test_job_expiring_in_the_queue_doesnt_run(self):
+        future = self._submit("expiring", 0.01)
+        time.sleep(0.05)
+        self.release.set()
+        self.assertEqual(self._status_code(future), 504)
+        self.assertEqual(self.order, [])
+        self.assertEqual(self.executor.stats()["expired"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
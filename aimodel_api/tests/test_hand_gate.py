@@ -0,0 +1,77 @@
+import unittest
+
+from ..aimodel.hand_gate import NO_HAND_REASON, HandPresenceGate
+from ..aimodel.transformations import TransformationType
+
+ROTATE = TransformationType.ROTATE.value
+RESIZE = TransformationType.RESIZE.value
+MP_HANDS = TransformationType.MP_HANDS.value
+U_NET = TransformationType.U_NET.value
+NORMALIZE = TransformationType.NORMALIZE.value
+ADD_GRAYSCALE_CHANNEL = TransformationType.ADD_GRAYSCALE_CHANNEL.value
+RESIZE128X128 = TransformationType.RESIZE128X128.value
+ADD_BATCH_DIM = TransformationType.ADD_BATCH_DIM.value
+
+# Chains of the models in models.json
+MODEL_CHAINS = {
+    1: [ROTATE, U_NET, ADD_GRAYSCALE_CHANNEL, ADD_BATCH_DIM],
+    2: [ROTATE, RESIZE, MP_HANDS, NORMALIZE, ADD_GRAYSCALE_CHANNEL, ADD_BATCH_DIM],
+    4: [ROTATE, RESIZE128X128, NORMALIZE, ADD_BATCH_DIM],
+}
+
+
+# Check that finds a hand if found is True, records that it ran
+class FakeCheck:
+    def __init__(self, transform_ids: list[int], found: bool):
+        self.transform_ids = transform_ids
+        self.found = found
+        self.runs = 0
+
+    def transform(self, transformed: dict):
+        self.runs += 1
+        return object() if self.found else None
+
+
+class HandPresenceGateTest(unittest.TestCase):
+    def test_checks_use_the_shortest_chain_of_the_models(self):
+        gate = HandPresenceGate.from_chains(MODEL_CHAINS, [MP_HANDS, U_NET])
+        self.assertEqual([check.transform_ids for check in gate.checks], [[ROTATE, RESIZE, MP_HANDS], [ROTATE, U_NET]])
+
+    def test_transformation_no_model_uses_runs_on_the_image(self):
+        gate = HandPresenceGate.from_chains({4: MODEL_CHAINS[4]}, [MP_HANDS])
+        self.assertEqual([check.transform_ids for check in gate.checks], [[MP_HANDS]])
+
+    def test_single_model_only_gets_the_checks_of_its_chain(self):
+        gate = HandPresenceGate.from_chains(MODEL_CHAINS, [MP_HANDS, U_NET])
+        self.assertEqual([check.transform_ids[-1] for check in gate.checks_for(MODEL_CHAINS[1])], [U_NET])
+        self.assertEqual([check.transform_ids[-1] for check in gate.checks_for(MODEL_CHAINS[2])], [MP_HANDS])
+        self.assertEqual(gate.checks_for(MODEL_CHAINS[4]), [])
+        self.assertEqual(len(gate.checks_for(None)), 2)
+
+    def test_input_sizes_of_the_checks(self):
+        gate = HandPresenceGate.from_chains(MODEL_CHAINS, [MP_HANDS])
+        self.assertEqual(len(gate.input_sizes(None)), 1)
+        self.assertIsNotNone(gate.input_sizes(None)[0])
+        self.assertEqual(gate.input_sizes(MODEL_CHAINS[4]), [])
+
+    def test_first_check_finding_a_hand_passes_the_image(self):
+        gate = HandPresenceGate([])
+        gate.checks = [FakeCheck([MP_HANDS], found=True), FakeCheck([U_NET], found=False)]
+        self.assertIsNone(gate.check({}))
+        self.assertEqual([check.runs for check in gate.checks], [1, 0])
+
+    def test_image_is_rejected_if_no_check_finds_a_hand(self):
+        gate = HandPresenceGate([])
+        gate.checks = [FakeCheck([MP_HANDS], found=False), FakeCheck([U_NET], found=False)]
+        self.assertEqual(gate.check({}), NO_HAND_REASON)
+        self.assertEqual([check.runs for check in gate.checks], [1, 1])
+
+    def test_request_without_checks_passes(self):
+        gate = HandPresenceGate([])
+        gate.checks = [FakeCheck([MP_HANDS], found=False)]
+        self.assertIsNone(gate.check({}, MODEL_CHAINS[4]))
+        self.assertEqual(gate.checks[0].runs, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
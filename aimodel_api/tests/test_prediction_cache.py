@@ -0,0 +1,47 @@
+import unittest
+from unittest import mock
+
+from ..aimodel.prediction_cache import PredictionCache
+
+
+class PredictionCacheTest(unittest.TestCase):
+    def test_hit_and_miss(self):
+        cache = PredictionCache(max_entries=4, ttl_s=60)
+        self.assertEqual(cache.get("a"), (False, None))
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), (True, 1))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = PredictionCache(max_entries=2, ttl_s=60)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(cache.get("b"), (False, None))
+        self.assertEqual(cache.get("a"), (True, 1))
+        self.assertEqual(cache.get("c"), (True, 3))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_entries_expire_after_ttl(self):
+        cache = PredictionCache(max_entries=4, ttl_s=10)
+        with mock.patch("time.monotonic", return_value=100.0):
+            cache.put("a", 1)
+        with mock.patch("time.monotonic", return_value=109.0):
+            self.assertEqual(cache.get("a"), (True, 1))
+        with mock.patch("time.monotonic", return_value=111.0):
+            self.assertEqual(cache.get("a"), (False, None))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_disabled_cache_stores_nothing(self):
+        cache = PredictionCache(max_entries=0)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), (False, None))
+
+    def test_digest_depends_only_on_the_content(self):
+        self.assertEqual(PredictionCache.digest(b"image"), PredictionCache.digest(b"image"))
+        self.assertNotEqual(PredictionCache.digest(b"image"), PredictionCache.digest(b"other"))
+
+
+if __name__ == "__main__":
+    unittest.main()
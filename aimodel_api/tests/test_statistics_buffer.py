@@ -0,0 +1,87 @@
+import unittest
+from unittest import mock
+
+from sqlalchemy.sql import Select
+
+from ..database import statistics_buffer
+from ..database.statistics_buffer import StatisticsBuffer
+
+
+# Session that applies the UPDATE statements to rows on commit, the totals SELECT or the commit can be made to fail
+class FakeSession:
+    def __init__(self, rows: dict, fail_commit: bool = False, fail_select: bool = False):
+        self.rows = rows
+        self.fail_commit = fail_commit
+        self.fail_select = fail_select
+        self.updates = []
+
+    def execute(self, statement):
+        if isinstance(statement, Select):
+            if self.fail_select:
+                raise RuntimeError("select failed")
+            return [(model_id, total, wrong) for model_id, (total, wrong) in self.rows.items()]
+        self.updates.append(statement)
+
+    def commit(self):
+        if self.fail_commit:
+            raise RuntimeError("commit failed")
+        for statement in self.updates:
+            model_id = statement.whereclause.right.value
+            values = {column.key: value.right.value for column, value in statement._values.items()}
+            total, wrong = self.rows[model_id]
+            self.rows[model_id] = (total + values["total_predictions"], wrong + values["wrong_predictions"])
+        self.updates = []
+
+    def rollback(self):
+        self.updates = []
+
+    def close(self):
+        pass
+
+
+class StatisticsBufferTest(unittest.TestCase):
+    def setUp(self):
+        StatisticsBuffer._instance = None
+        self.buffer = StatisticsBuffer()
+        self.rows = {1: (10, 2)}
+
+    def tearDown(self):
+        StatisticsBuffer._instance = None
+
+    def _flush(self, **failures) -> FakeSession:
+        session = FakeSession(self.rows, **failures)
+        with mock.patch.object(statistics_buffer, "SessionLocal", return_value=session):
+            self.buffer.flush()
+        return session
+
+    def test_flush_writes_the_pending_counters_and_reads_the_totals(self):
+        self.buffer.add(1, wrong_prediction=True)
+        self.buffer.add(1, wrong_prediction=False)
+        self._flush()
+        self.assertEqual(self.rows[1], (12, 3))
+        self.assertEqual(self.buffer.pending(), {})
+        self.assertEqual(self.buffer.totals(), {1: (12, 3)})
+
+    def test_failed_commit_keeps_the_counters(self):
+        self.buffer.add(1, wrong_prediction=True)
+        self._flush(fail_commit=True)
+        self.assertEqual(self.rows[1], (10, 2))
+        self.assertEqual(self.buffer.pending(), {1: (1, 1)})
+        self._flush()
+        self.assertEqual(self.rows[1], (11, 3))
+
+    def test_failed_totals_read_doesnt_write_the_counters_again(self):
+        self._flush()
+        self.buffer.add(1, wrong_prediction=True)
+        self._flush(fail_select=True)
+        self.assertEqual(self.rows[1], (11, 3))
+        self.assertEqual(self.buffer.pending(), {})
+        self.assertEqual(self.buffer.totals(), {1: (11, 3)})
+        # The totals are read again by the next flush, without pending counters
+        self.rows[1] = (20, 5)
+        self._flush()
+        self.assertEqual(self.buffer.totals(), {1: (20, 5)})
+
+
+if __name__ == "__main__":
+    unittest.main()